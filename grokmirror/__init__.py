@@ -21,7 +21,6 @@ import time
 import json
 import fnmatch
 import subprocess
-import requests
 import logging
 import logging.handlers
 import hashlib
@@ -30,13 +29,9 @@ import uuid
 import tempfile
 import shutil
 import gzip
-import datetime
 
 from fcntl import lockf, LOCK_EX, LOCK_UN, LOCK_NB
 
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-
 from typing import Optional, Tuple, Union
 
 
@@ -49,10 +44,16 @@ GITBIN = '/usr/bin/git'
 logger = logging.getLogger(__name__)
 
 _alt_repo_map = None
+# Whether the system gitconfig can affect gitweb.* settings in repos
+_system_gitweb = None
 
 # Used to store our requests session
 REQSESSION = None
 
+# We only need the file contents on disk before we rename it into place,
+# not the inode metadata, but not every platform has fdatasync
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
 OBST_PREAMBULE = ('# WARNING: This is a grokmirror object storage repository.\n'
                   '# Deleting or moving it will cause corruption in the following repositories\n'
                   '# (caution, this list may be incomplete):\n')
@@ -61,6 +62,11 @@ OBST_PREAMBULE = ('# WARNING: This is a grokmirror object storage repository.\n'
 def get_requests_session():
     global REQSESSION
     if REQSESSION is None:
+        # requests is slow to import and only needed by the commands that
+        # talk http, so don't make grok-fsck and grok-manifest pay for it
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
         REQSESSION = requests.session()
         retry = Retry(connect=3, backoff_factor=0.5)
         adapter = HTTPAdapter(max_retries=retry)
@@ -93,6 +99,29 @@ def get_config_from_git(fullpath, regexp, defaults=None):
     return gitconfig
 
 
+def get_gitweb_owner(fullpath):
+    # Most repos don't set gitweb.owner, so look at the repo config ourselves
+    # before forking git-config to parse it properly. We run git with
+    # an empty environment, so only the system config can add to it.
+    global _system_gitweb
+    if _system_gitweb is None:
+        args = ['config', '--system', '-z', '--get-regexp', r'^(gitweb\.|include)']
+        ecode, out, err = run_git_command(None, args)
+        _system_gitweb = len(out) > 0
+    if not _system_gitweb:
+        try:
+            contents = read_small_file(os.path.join(fullpath, 'config')).lower()
+            if contents.find(b'gitweb') < 0 and contents.find(b'include') < 0:
+                return None
+        except IOError:
+            pass
+
+    ecode, out, err = run_git_command(fullpath, ['config', '--get', 'gitweb.owner'])
+    if ecode > 0 or not out:
+        return None
+    return out
+
+
 def set_git_config(fullpath, param, value, operation='--replace-all'):
     args = ['config', operation, param, value]
     ecode, out, err = run_git_command(fullpath, args)
@@ -110,7 +139,8 @@ def run_shell_command(cmdargs: list, stdin: Optional[bytes] = None, decode: bool
                       env: Optional[dict] = None) -> Tuple[int, Union[str, bytes], Union[str, bytes]]:
     if not env:
         env = dict()
-    logger.debug('Running: %s', ' '.join(cmdargs))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Running: %s', ' '.join(cmdargs))
 
     child = subprocess.Popen(cmdargs, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
     output, error = child.communicate(input=stdin)
@@ -122,8 +152,7 @@ def run_shell_command(cmdargs: list, stdin: Optional[bytes] = None, decode: bool
     return child.returncode, output, error
 
 
-def run_git_command(fullpath: Optional[str], args: list, stdin: Optional[bytes] = None,
-                    decode: bool = True) -> Tuple[int, Union[str, bytes], Union[str, bytes]]:
+def get_git_cmdargs(fullpath: Optional[str], args: list) -> list:
     if 'GITBIN' in os.environ:
         _git = os.environ['GITBIN']
     else:
@@ -138,6 +167,12 @@ def run_git_command(fullpath: Optional[str], args: list, stdin: Optional[bytes]
     else:
         cmdargs = [_git, '--no-pager'] + args
 
+    return cmdargs
+
+
+def run_git_command(fullpath: Optional[str], args: list, stdin: Optional[bytes] = None,
+                    decode: bool = True) -> Tuple[int, Union[str, bytes], Union[str, bytes]]:
+    cmdargs = get_git_cmdargs(fullpath, args)
     return run_shell_command(cmdargs, stdin, decode=decode)
 
 
@@ -154,7 +189,8 @@ def lock_repo(fullpath, nonblocking=False):
     repolock = _lockname(fullpath)
 
     logger.debug('Attempting to exclusive-lock %s', repolock)
-    lockfh = open(repolock, 'w')
+    # Opening for append, so we don't truncate the lockfile every time
+    lockfh = open(repolock, 'a')
 
     if nonblocking:
         flags = LOCK_EX | LOCK_NB
@@ -233,43 +269,130 @@ def get_repo_obj_info(fullpath):
     return obj_info
 
 
+def get_refs_stamp(fullpath, ignorerefs=None):
+    # Put together everything we can stat that would change if any refs
+    # changed. Git replaces ref files by renaming a new one into place, so
+    # the inode number changes even if the size and mtime don't.
+    if os.path.exists(os.path.join(fullpath, 'reftable')):
+        return None
+    hasher = hashlib.sha1()
+    if ignorerefs:
+        hasher.update(repr(sorted(ignorerefs)).encode())
+    try:
+        st = os.stat(os.path.join(fullpath, 'packed-refs'))
+        hasher.update(b'packed-refs %d %d %d\n' % (st.st_ino, st.st_size, st.st_mtime_ns))
+    except FileNotFoundError:
+        pass
+    refsdir = os.path.join(fullpath, 'refs')
+    if not os.path.isdir(refsdir):
+        return None
+    for root, dirs, files in os.walk(refsdir):
+        dirs.sort()
+        for name in [''] + sorted(files):
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # raced with a ref update, so this stamp is useless
+                return None
+            hasher.update(b'%s %d %d %d\n' % (path.encode(), st.st_ino, st.st_size, st.st_mtime_ns))
+
+    return hasher.hexdigest()
+
+
+def get_refs_cache(fullpath, refstamp):
+    if refstamp is None:
+        return None
+    try:
+        contents = read_small_file(os.path.join(fullpath, 'grokmirror.refstamp'))
+        stamp, latest, fingerprint = contents.decode().split()
+    except (IOError, ValueError):
+        return None
+    if stamp != refstamp:
+        return None
+    logger.debug('Refs unchanged in %s', fullpath)
+    return int(latest), fingerprint
+
+
+def set_refs_cache(fullpath, refstamp, latest, fingerprint):
+    if refstamp is None:
+        return
+    with open(os.path.join(fullpath, 'grokmirror.refstamp'), 'w') as fh:
+        fh.write('%s %d %s\n' % (refstamp, latest, fingerprint))
+
+
+def read_small_file(path, bufsize=4096):
+    # We read a few tiny files from every repo on every run, and open() sets up
+    # a whole io stack (and does a few extra syscalls) for each of them.
+    # Raises OSError just like open() would.
+    chunks = list()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while True:
+            chunk = os.read(fd, bufsize)
+            chunks.append(chunk)
+            # A short read from a regular file means we're at the end
+            if len(chunk) < bufsize:
+                break
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
 def get_repo_defs(toplevel, gitdir, usenow=False, ignorerefs=None):
     fullpath = os.path.join(toplevel, gitdir.lstrip('/'))
     description = None
     try:
-        descfile = os.path.join(fullpath, 'description')
-        with open(descfile, 'rb') as fh:
-            contents = fh.read().strip()
-            if len(contents) and contents.find(b'edit this file') < 0:
-                # We don't need to tell mirrors to edit this file
-                description = contents.decode(errors='replace')
+        contents = read_small_file(os.path.join(fullpath, 'description')).strip()
+        if len(contents) and contents.find(b'edit this file') < 0:
+            # We don't need to tell mirrors to edit this file
+            description = contents.decode(errors='replace')
     except IOError:
         pass
 
-    entries = get_config_from_git(fullpath, r'gitweb\..*')
-    owner = entries.get('owner', None)
+    owner = get_gitweb_owner(fullpath)
 
     modified = 0
+    fingerprint = None
+    fingerprinted = False
+    cached = None
 
     if not usenow:
-        args = ['for-each-ref', '--sort=-committerdate', '--format=%(committerdate:iso-strict)', '--count=1']
-        ecode, out, err = run_git_command(fullpath, args)
-        if len(out):
-            try:
-                modified = datetime.datetime.fromisoformat(out)
-            except AttributeError:
-                # Python 3.6 doesn't have fromisoformat
-                # remove : from the TZ info
-                out = out[:-3] + out[-2:]
-                modified = datetime.datetime.strptime(out, '%Y-%m-%dT%H:%M:%S%z')
+        # Refs don't change between most runs, so don't look at them again
+        # if they are exactly the same as last time
+        refstamp = get_refs_stamp(fullpath, ignorerefs=ignorerefs)
+        cached = get_refs_cache(fullpath, refstamp)
+        if cached is not None:
+            fingerprinted = True
+            latest, fingerprint = cached
+        else:
+            # Get the refs and their commit dates in one go, so we don't have to
+            # run show-ref separately just to calculate the fingerprint
+            args = ['for-each-ref', '--format=%(objectname) %(refname)%00%(committerdate:unix)']
+            ecode, out, err = run_git_command(fullpath, args)
+            latest = 0
+            if ecode == 0:
+                fingerprinted = True
+                showref = list()
+                for line in out.split('\n'):
+                    if not line:
+                        continue
+                    refline, cdate = line.split('\x00', 1)
+                    showref.append(refline)
+                    # Tags and other non-commits don't have a committer date
+                    if cdate and int(cdate) > latest:
+                        latest = int(cdate)
+                if showref:
+                    fingerprint = fingerprint_refs('\n'.join(showref), ignorerefs=ignorerefs)
+                    set_refs_cache(fullpath, refstamp, latest, fingerprint)
+        modified = latest
 
     if not modified:
-        modified = datetime.datetime.now()
+        modified = int(time.time())
 
     head = None
     try:
-        with open(os.path.join(fullpath, 'HEAD')) as fh:
-            head = fh.read().strip()
+        head = read_small_file(os.path.join(fullpath, 'HEAD')).decode().strip()
     except IOError:
         pass
 
@@ -283,11 +406,14 @@ def get_repo_defs(toplevel, gitdir, usenow=False, ignorerefs=None):
     # "state fingerprint" -- basically the output of "git show-ref | sha1sum".
     # git show-ref output is deterministic and should accurately list all refs
     # and their relation to heads/tags/etc.
-    fingerprint = get_repo_fingerprint(toplevel, gitdir, force=True, ignorerefs=ignorerefs)
-    # Record it in the repo for other use
-    set_repo_fingerprint(toplevel, gitdir, fingerprint)
+    if not fingerprinted:
+        fingerprint = get_repo_fingerprint(toplevel, gitdir, force=True, ignorerefs=ignorerefs)
+    # Record it in the repo for other use, unless we already did that
+    # the last time we saw these exact refs
+    if cached is None or not os.path.exists(os.path.join(fullpath, 'grokmirror.fingerprint')):
+        set_repo_fingerprint(toplevel, gitdir, fingerprint)
     repoinfo = {
-        'modified': int(modified.timestamp()),
+        'modified': modified,
         'fingerprint': fingerprint,
         'head': head,
     }
@@ -307,10 +433,9 @@ def get_altrepo(fullpath):
     altfile = os.path.join(fullpath, 'objects', 'info', 'alternates')
     altdir = None
     try:
-        with open(altfile, 'r') as fh:
-            contents = fh.read().strip()
-            if len(contents) > 8 and contents[-8:] == '/objects':
-                altdir = os.path.realpath(contents[:-8])
+        contents = read_small_file(altfile).decode().strip()
+        if len(contents) > 8 and contents[-8:] == '/objects':
+            altdir = os.path.realpath(contents[:-8])
     except IOError:
         pass
 
@@ -589,6 +714,15 @@ def _fetch_objstore_repo_using_plumbing(srcrepo, obstrepo, virtref):
     return True
 
 
+def get_objstore_fingerprint(obstrepo, fullpath):
+    # The fingerprint of fullpath as of the last successful fetch into obstrepo
+    fpfile = os.path.join(obstrepo, 'grokmirror.%s.fingerprint' % objstore_virtref(fullpath))
+    try:
+        return read_small_file(fpfile).decode().strip()
+    except OSError:
+        return None
+
+
 def fetch_objstore_repo(obstrepo, fullpath=None, pack_refs=False, use_plumbing=False):
     my_remotes = list_repo_remotes(obstrepo, withurl=True)
     if fullpath:
@@ -764,6 +898,28 @@ def get_forkgroups(obstdir, toplevel):
     return forkgroups
 
 
+def fingerprint_refs(showref, ignorerefs=None):
+    # Takes the output of git-show-ref (or anything formatted the same way)
+    if ignorerefs:
+        hasher = hashlib.sha1()
+        for line in showref.split('\n'):
+            rhash, rname = line.split(maxsplit=1)
+            ignored = False
+            for ignoreref in ignorerefs:
+                if fnmatch.fnmatch(rname, ignoreref):
+                    ignored = True
+                    break
+            if ignored:
+                continue
+            hasher.update(line.encode() + b'\n')
+
+        return hasher.hexdigest()
+
+    # We add the final "\n" to be compatible with cmdline output
+    # of git-show-ref
+    return hashlib.sha1(showref.encode() + b'\n').hexdigest()
+
+
 def get_repo_fingerprint(toplevel, gitdir, force=False, ignorerefs=None):
     fullpath = os.path.join(toplevel, gitdir.lstrip('/'))
     if not os.path.exists(fullpath):
@@ -782,24 +938,7 @@ def get_repo_fingerprint(toplevel, gitdir, force=False, ignorerefs=None):
             logger.debug('No heads in %s, nothing to fingerprint.', fullpath)
             return None
 
-        if ignorerefs:
-            hasher = hashlib.sha1()
-            for line in out.split('\n'):
-                rhash, rname = line.split(maxsplit=1)
-                ignored = False
-                for ignoreref in ignorerefs:
-                    if fnmatch.fnmatch(rname, ignoreref):
-                        ignored = True
-                        break
-                if ignored:
-                    continue
-                hasher.update(line.encode() + b'\n')
-
-            fingerprint = hasher.hexdigest()
-        else:
-            # We add the final "\n" to be compatible with cmdline output
-            # of git-show-ref
-            fingerprint = hashlib.sha1(out.encode() + b'\n').hexdigest()
+        fingerprint = fingerprint_refs(out, ignorerefs=ignorerefs)
 
         # Save it for future use
         if not force:
@@ -859,60 +998,86 @@ def is_obstrepo(fullpath, obstdir=None):
     return os.path.exists(os.path.join(fullpath, 'grokmirror.objstore'))
 
 
-def find_all_gitdirs(toplevel, ignore=None, normalize=False, exclude_objstore=True):
+def iter_gitdirs(toplevel, ignore=None, normalize=False, exclude_objstore=True, symlinks=None):
+    # Hands out repos as the tree walk finds them, so callers can start
+    # working on them before the walk is complete. If symlinks is a set,
+    # we add any repos we find that are symlinks to it, since scandir already
+    # told us that for free.
     global _alt_repo_map
     if _alt_repo_map is None:
-        _alt_repo_map = dict()
-        build_amap = True
+        amap = dict()
     else:
-        build_amap = False
+        amap = None
 
     if ignore is None:
         ignore = set()
 
     logger.info('   search: finding all repos in %s', toplevel)
     logger.debug('Ignore list: %s', ' '.join(ignore))
-    gitdirs = set()
-    for root, dirs, files in os.walk(toplevel, topdown=True):
-        if not len(dirs):
+    seen = set()
+    # Same order as os.walk(topdown=True), but we get to keep the DirEntry
+    # objects, which saves us stat calls
+    todo = [toplevel]
+    while todo:
+        root = todo.pop()
+        subdirs = list()
+        try:
+            with os.scandir(root) as it:
+                entries = list(it)
+        except OSError:
             continue
 
-        torm = set()
-        for name in dirs:
-            fullpath = os.path.join(root, name)
+        for entry in entries:
+            try:
+                if not entry.is_dir():
+                    continue
+            except OSError:
+                continue
+            fullpath = entry.path
             # Should we ignore this dir?
             ignored = False
             for ignoredir in ignore:
                 if fnmatch.fnmatch(fullpath, ignoredir):
-                    torm.add(name)
                     ignored = True
                     break
             if ignored:
                 continue
             if not is_bare_git_repo(fullpath):
+                # Don't follow symlinks when looking for repos
+                if not entry.is_symlink():
+                    subdirs.append(fullpath)
                 continue
             if exclude_objstore and os.path.exists(os.path.join(fullpath, 'grokmirror.objstore')):
                 continue
             if normalize:
                 fullpath = os.path.realpath(fullpath)
 
-            logger.debug('Found %s', os.path.join(root, name))
-            gitdirs.add(fullpath)
-            torm.add(name)
+            if fullpath in seen:
+                continue
+            logger.debug('Found %s', entry.path)
+            seen.add(fullpath)
+            if symlinks is not None and entry.is_symlink():
+                symlinks.add(fullpath)
 
-            if build_amap:
+            if amap is not None:
                 altrepo = get_altrepo(fullpath)
-                if not altrepo:
-                    continue
-                if altrepo not in _alt_repo_map:
-                    _alt_repo_map[altrepo] = set()
-                _alt_repo_map[altrepo].add(fullpath)
+                if altrepo:
+                    if altrepo not in amap:
+                        amap[altrepo] = set()
+                    amap[altrepo].add(fullpath)
+
+            yield fullpath
 
-        for name in torm:
-            # don't recurse into the found *.git dirs
-            dirs.remove(name)
+        # don't recurse into the found *.git dirs
+        todo.extend(reversed(subdirs))
 
-    return gitdirs
+    # Only save the map once we've seen the whole tree
+    if amap is not None and _alt_repo_map is None:
+        _alt_repo_map = amap
+
+
+def find_all_gitdirs(toplevel, ignore=None, normalize=False, exclude_objstore=True):
+    return set(iter_gitdirs(toplevel, ignore=ignore, normalize=normalize, exclude_objstore=exclude_objstore))
 
 
 def manifest_lock(manifile):
@@ -921,7 +1086,7 @@ def manifest_lock(manifile):
         logger.debug('Manifest %s already locked', manifile)
 
     manilock = _lockname(manifile)
-    MANIFEST_LOCKH = open(manilock, 'w')
+    MANIFEST_LOCKH = open(manilock, 'a')
     logger.debug('Attempting to lock %s', manilock)
     lockf(MANIFEST_LOCKH, LOCK_EX)
     logger.debug('Manifest lock obtained')
@@ -978,29 +1143,54 @@ def read_manifest(manifile, wait=False):
     return manifest
 
 
-def write_manifest(manifile, manifest, mtime=None, pretty=False):
+def iter_manifest_json(manifest, pretty=False, batchsize=1000):
+    if pretty:
+        # Only meant for debugging, so don't bother being clever
+        yield json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+        return
+
+    # Encode a batch of repos at a time, so we never hold the whole encoded
+    # manifest in memory at once. This produces exactly the same output as
+    # json.dumps(manifest).
+    sep = '{'
+    batch = dict()
+    for gitdir, repoinfo in manifest.items():
+        batch[gitdir] = repoinfo
+        if len(batch) >= batchsize:
+            yield (sep + json.dumps(batch)[1:-1]).encode('utf-8')
+            sep = ', '
+            batch = dict()
+    if len(batch):
+        yield (sep + json.dumps(batch)[1:-1] + '}').encode('utf-8')
+    elif sep == '{':
+        yield b'{}'
+    else:
+        yield b'}'
+
+
+def write_manifest(manifile, manifest, mtime=None, pretty=False, compresslevel=6):
     logger.debug('Writing new %s', manifile)
 
     (dirname, basename) = os.path.split(manifile)
     (fd, tmpfile) = tempfile.mkstemp(prefix=basename, dir=dirname)
-    fh = os.fdopen(fd, 'wb', 0)
+    # gzip hands us compressed data in small pieces, so buffer our writes
+    fh = os.fdopen(fd, 'wb', 65536)
     logger.debug('Created a temporary file in %s', tmpfile)
     logger.debug('Writing to %s', tmpfile)
     try:
-        if pretty:
-            jdata = json.dumps(manifest, indent=2, sort_keys=True)
-        else:
-            jdata = json.dumps(manifest)
-
-        jdata = jdata.encode('utf-8')
         if manifile.endswith('.gz'):
-            gfh = gzip.GzipFile(fileobj=fh, mode='wb')
-            gfh.write(jdata)
+            # Level 6 is several times faster than the default 9, and the
+            # output is only about 1% larger for a manifest
+            gfh = gzip.GzipFile(fileobj=fh, mode='wb', compresslevel=compresslevel)
+            for chunk in iter_manifest_json(manifest, pretty=pretty):
+                gfh.write(chunk)
             gfh.close()
         else:
-            fh.write(jdata)
+            for chunk in iter_manifest_json(manifest, pretty=pretty):
+                fh.write(chunk)
 
-        os.fsync(fd)
+        fh.flush()
+        fdatasync(fd)
         fh.close()
         # set mode to current umask
         curmask = os.umask(0)
@@ -1025,7 +1215,7 @@ def load_config_file(cfgfile):
         sys.stderr.write('ERORR: File does not exist: %s\n' % cfgfile)
         sys.exit(1)
     config = ConfigParser(interpolation=ExtendedInterpolation())
-    config.read(cfgfile)
+    config.read(cfgfile, encoding='utf-8')
 
     if 'core' not in config:
         sys.stderr.write('ERROR: Section [core] must exist in: %s\n' % cfgfile)
@@ -1113,7 +1303,14 @@ def init_logger(subcommand, logfile, loglevel, verbose):
     global logger
 
     logger = logging.getLogger('grokmirror')
-    logger.setLevel(logging.DEBUG)
+
+    if verbose:
+        streamlevel = logging.INFO
+    else:
+        streamlevel = logging.CRITICAL
+    # Don't let the logger accept records that no handler is going to emit,
+    # or we end up building every debug message just to throw it away.
+    minlevel = streamlevel
 
     if logfile:
         ch = logging.handlers.WatchedFileHandler(os.path.expanduser(logfile))
@@ -1121,15 +1318,14 @@ def init_logger(subcommand, logfile, loglevel, verbose):
         ch.setFormatter(formatter)
         ch.setLevel(loglevel)
         logger.addHandler(ch)
+        minlevel = min(minlevel, loglevel)
+
+    logger.setLevel(minlevel)
 
     ch = logging.StreamHandler()
     formatter = logging.Formatter('%(message)s')
     ch.setFormatter(formatter)
-
-    if verbose:
-        ch.setLevel(logging.INFO)
-    else:
-        ch.setLevel(logging.CRITICAL)
+    ch.setLevel(streamlevel)
 
     logger.addHandler(ch)
     return logger
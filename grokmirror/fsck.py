@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 
 import grokmirror
 import logging
@@ -24,19 +25,25 @@ import json
 import random
 import datetime
 import shutil
+import tempfile
 import gc
 import fnmatch
 import io
-import smtplib
 
 from pathlib import Path
 
-from email.message import EmailMessage
 from fcntl import lockf, LOCK_EX, LOCK_UN, LOCK_NB
 
 # default basic logger. We override it later.
 logger = logging.getLogger(__name__)
 
+# Compiled substring matchers, keyed by the config value they came from
+_substring_res = dict()
+_split_flags = dict()
+_realpaths = dict()
+# Last status file contents we've seen, keyed by path, with the stat info they came from
+_disk_status = dict()
+
 
 def log_errors(fullpath, cmdargs, lines):
     logger.critical('%s reports errors:', fullpath)
@@ -192,24 +199,43 @@ def merge_siblings(siblings, amap):
     return mdest
 
 
+def get_substring_re(cfgval):
+    # Turn a multi-line config value into a single regex matching any of the
+    # substrings listed, so we don't have to scan each line once per entry
+    if cfgval not in _substring_res:
+        estrings = set([x.strip() for x in cfgval.split('\n')])
+        _substring_res[cfgval] = re.compile('|'.join(re.escape(x) for x in estrings))
+    return _substring_res[cfgval]
+
+
+def get_split_flags(cfgval):
+    # Repack flags come from config and are the same for every repo
+    if cfgval not in _split_flags:
+        _split_flags[cfgval] = tuple(cfgval.split())
+    return _split_flags[cfgval]
+
+
+def get_realpath(path):
+    # Only use this for paths from config, which don't change during the run
+    if path not in _realpaths:
+        _realpaths[path] = os.path.realpath(path)
+    return _realpaths[path]
+
+
 def check_reclone_error(fullpath, config, errors):
     reclone = None
-    toplevel = os.path.realpath(config['core'].get('toplevel'))
-    errlist = config['fsck'].get('reclone_on_errors', '').split('\n')
+    toplevel = get_realpath(config['core'].get('toplevel'))
+    reclone_re = get_substring_re(config['fsck'].get('reclone_on_errors', ''))
     for line in errors:
-        for estring in errlist:
-            if line.find(estring) != -1:
-                # is this repo used for alternates?
-                gitdir = '/' + os.path.relpath(fullpath, toplevel).lstrip('/')
-                if grokmirror.is_alt_repo(toplevel, gitdir):
-                    logger.critical('\tused for alternates, not requesting auto-reclone')
-                    return
-                else:
-                    reclone = line
-                    logger.critical('\trequested auto-reclone')
-                break
-            if reclone is not None:
-                break
+        if reclone_re.search(line):
+            # is this repo used for alternates?
+            gitdir = '/' + os.path.relpath(fullpath, toplevel).lstrip('/')
+            if grokmirror.is_alt_repo(toplevel, gitdir):
+                logger.critical('\tused for alternates, not requesting auto-reclone')
+                return
+            reclone = line
+            logger.critical('\trequested auto-reclone')
+            break
     if reclone is None:
         return
 
@@ -279,8 +305,8 @@ def is_safe_to_prune(fullpath, config):
     if config['fsck'].get('prune', 'yes') != 'yes':
         logger.debug('Pruning disabled in config file')
         return False
-    toplevel = os.path.realpath(config['core'].get('toplevel'))
-    obstdir = os.path.realpath(config['core'].get('objstore'))
+    toplevel = get_realpath(config['core'].get('toplevel'))
+    obstdir = get_realpath(config['core'].get('objstore'))
     gitdir = '/' + os.path.relpath(fullpath, toplevel).lstrip('/')
     if grokmirror.is_obstrepo(fullpath, obstdir):
         # We only prune if all repos pointing to us are public
@@ -299,7 +325,7 @@ def is_safe_to_prune(fullpath, config):
 
 
 def remove_ignored_errors(output, config):
-    ierrors = set([x.strip() for x in config['fsck'].get('ignore_errors', '').split('\n')])
+    ignore_re = get_substring_re(config['fsck'].get('ignore_errors', ''))
     debug = list()
     warn = list()
     for line in output.split('\n'):
@@ -307,13 +333,9 @@ def remove_ignored_errors(output, config):
         # ignore any blank linkes
         if not len(line):
             continue
-        ignored = False
-        for estring in ierrors:
-            if line.find(estring) != -1:
-                ignored = True
-                debug.append(line)
-                break
-        if not ignored:
+        if ignore_re.search(line):
+            debug.append(line)
+        else:
             warn.append(line)
     if debug:
         logger.debug('Stderr: %s', '\n'.join(debug))
@@ -324,8 +346,8 @@ def remove_ignored_errors(output, config):
 def run_git_repack(fullpath, config, level=1, prune=True):
     # Returns false if we hit any errors on the way
     repack_ok = True
-    obstdir = os.path.realpath(config['core'].get('objstore'))
-    toplevel = os.path.realpath(config['core'].get('toplevel'))
+    obstdir = get_realpath(config['core'].get('objstore'))
+    toplevel = get_realpath(config['core'].get('toplevel'))
     gitdir = '/' + os.path.relpath(fullpath, toplevel).lstrip('/')
 
     if prune:
@@ -344,12 +366,12 @@ def run_git_repack(fullpath, config, level=1, prune=True):
 
     # Figure out what our repack flags should be.
     repack_flags = list()
-    rregular = config['fsck'].get('extra_repack_flags', '').split()
+    rregular = get_split_flags(config['fsck'].get('extra_repack_flags', ''))
     if len(rregular):
         repack_flags += rregular
 
     full_repack_flags = ['-f', '--pack-kept-objects']
-    rfull = config['fsck'].get('extra_repack_flags_full', '').split()
+    rfull = get_split_flags(config['fsck'].get('extra_repack_flags_full', ''))
     if len(rfull):
         full_repack_flags += rfull
 
@@ -454,14 +476,18 @@ def run_git_repack(fullpath, config, level=1, prune=True):
     return repack_ok
 
 
-def run_git_fsck(fullpath, config, conn_only=False):
+def run_git_fsck(fullpath, config, conn_only=False, checked=None):
     args = ['fsck', '--no-progress', '--no-dangling', '--no-reflogs']
-    obstdir = os.path.realpath(config['core'].get('objstore'))
+    obstdir = get_realpath(config['core'].get('objstore'))
     # If it's got an obstrepo, always run as connectivity-only
     altrepo = grokmirror.get_altrepo(fullpath)
     if altrepo and grokmirror.is_obstrepo(altrepo, obstdir):
         logger.debug('Repo uses objstore, forcing connectivity-only')
         conn_only = True
+    elif altrepo and checked is not None and altrepo in checked:
+        # A full fsck would verify all the objects in the alternates repo again
+        logger.debug('Alternates repo already checked during this run, forcing connectivity-only')
+        conn_only = True
     if conn_only:
         args.append('--connectivity-only')
         logger.info('     fsck: running with --connectivity-only')
@@ -477,6 +503,9 @@ def run_git_fsck(fullpath, config, conn_only=False):
             log_errors(fullpath, args, warn)
             check_reclone_error(fullpath, config, warn)
 
+    if checked is not None and not conn_only:
+        checked.add(fullpath)
+
 
 def run_git_commit_graph(fullpath, extraflags=None):
     # Does our version of git support commit-graph?
@@ -508,6 +537,142 @@ def check_precious_objects(fullpath):
     return grokmirror.is_precious(fullpath)
 
 
+def lock_status(lockfile, attempts=6):
+    # Try to obtain the status lock, backing off exponentially between attempts
+    # instead of blocking forever. Returns the lock handle or None.
+    logger.debug('Attempting to obtain lock on %s', lockfile)
+    flockh = open(lockfile, 'a')
+    delay = 1
+    for attempt in range(attempts):
+        try:
+            lockf(flockh, LOCK_EX | LOCK_NB)
+            return flockh
+        except IOError:
+            if attempt + 1 < attempts:
+                logger.debug('Lock on %s is busy, retrying in %ss', lockfile, delay)
+                time.sleep(delay)
+                # Don't wait longer than 30 seconds between attempts
+                delay = min(delay * 2, 30)
+
+    flockh.close()
+    return None
+
+
+def unlock_status(flockh):
+    lockf(flockh, LOCK_UN)
+    flockh.close()
+
+
+def read_status(statusfile):
+    if not os.path.exists(statusfile):
+        return dict()
+
+    with open(statusfile, 'r') as stfh:
+        # noinspection PyBroadException
+        try:
+            # Format of the status file:
+            #  {
+            #    '/full/path/to/repository': {
+            #      'lastcheck': 'YYYY-MM-DD' or 'never',
+            #      'nextcheck': 'YYYY-MM-DD',
+            #      'lastrepack': 'YYYY-MM-DD',
+            #      'fingerprint': 'sha-1',
+            #      's_elapsed': seconds,
+            #      'quick_repack_count': times,
+            #    },
+            #    ...
+            #  }
+            return json.loads(stfh.read())
+        except:
+            logger.critical('Failed to parse %s', statusfile)
+            return None
+
+
+def write_status(statusfile, status):
+    logger.debug('Updating status file in %s', statusfile)
+    # Write to a tempfile and move it into place, so we never leave
+    # a half-written status file behind if we die in the process
+    (dirname, basename) = os.path.split(statusfile)
+    (fd, tmpfile) = tempfile.mkstemp(prefix=basename, dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as stfh:
+            stfh.write(json.dumps(status, indent=2))
+            stfh.flush()
+            grokmirror.fdatasync(fd)
+        # set mode to current umask
+        curmask = os.umask(0)
+        os.chmod(tmpfile, 0o0666 ^ curmask)
+        os.umask(curmask)
+        os.replace(tmpfile, statusfile)
+
+    finally:
+        # If something failed, don't leave these trailing around
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+
+def get_stat_key(statusfile):
+    try:
+        st = os.stat(statusfile)
+    except FileNotFoundError:
+        return None
+    # We always replace the file, so a new inode means a new write
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def read_disk_status(statusfile):
+    # Only parse the status file again if someone has written to it since we
+    # last looked, since it can be big and we check it for every repo we process
+    key = get_stat_key(statusfile)
+    if key is None:
+        return dict()
+    if statusfile in _disk_status and _disk_status[statusfile][0] == key:
+        return _disk_status[statusfile][1]
+    disk_status = read_status(statusfile)
+    if disk_status is None:
+        disk_status = dict()
+    _disk_status[statusfile] = (key, disk_status)
+    return disk_status
+
+
+def merge_status(statusfile, lockfile, status, touched, attempts=6):
+    # We don't hold the status lock while working on repos, so another grok-fsck
+    # may have written to the status file in the meantime. Only write out the
+    # entries we've touched on top of whatever is currently on disk.
+    flockh = lock_status(lockfile, attempts=attempts)
+    if flockh is None:
+        logger.debug('Could not lock %s, will try updating it later', statusfile)
+        return False
+
+    disk_status = dict(read_disk_status(statusfile))
+    for fullpath in touched:
+        if fullpath in status:
+            # Copy, so later changes to status don't leak into what we know is on disk
+            disk_status[fullpath] = dict(status[fullpath])
+
+    write_status(statusfile, disk_status)
+    # We know what we just wrote, so no need to parse it again
+    _disk_status[statusfile] = (get_stat_key(statusfile), disk_status)
+    unlock_status(flockh)
+    return True
+
+
+def is_done_elsewhere(statusfile, status, fullpath, action, todayiso):
+    # Another grok-fsck may have started while we were working on other repos
+    # and already done this one today, so check what it wrote to the status file
+    disk_status = read_disk_status(statusfile)
+    if fullpath not in disk_status:
+        return False
+    if action == 'repack':
+        key = 'lastrepack'
+    else:
+        key = 'lastcheck'
+    if disk_status[fullpath].get(key) == todayiso and status[fullpath].get(key) != todayiso:
+        status[fullpath] = dict(disk_status[fullpath])
+        return True
+    return False
+
+
 def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 repack_all_quick=False, repack_all_full=False):
 
@@ -524,13 +689,12 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
         logger.critical('Directory %s is absent', st_dir)
         return 1
 
-    # Lock the tree to make sure we only run one instance
+    # We only hold the status lock while figuring out which repos need work
+    # and when writing out the status file. The long-running repacks and fscks
+    # are protected by per-repo locks, so other grok-fsck runs can overlap.
     lockfile = os.path.join(st_dir, '.%s.lock' % os.path.basename(statusfile))
-    logger.debug('Attempting to obtain lock on %s', lockfile)
-    flockh = open(lockfile, 'w')
-    try:
-        lockf(flockh, LOCK_EX | LOCK_NB)
-    except IOError:
+    flockh = lock_status(lockfile)
+    if flockh is None:
         logger.info('Could not obtain exclusive lock on %s', lockfile)
         logger.info('Assuming another process is running.')
         return 0
@@ -540,37 +704,19 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
     grokmirror.manifest_lock(manifile)
     manifest = grokmirror.read_manifest(manifile)
 
-    if os.path.exists(statusfile):
-        logger.info('   status: reading %s', statusfile)
-        stfh = open(statusfile, 'r')
-        # noinspection PyBroadException
-        try:
-            # Format of the status file:
-            #  {
-            #    '/full/path/to/repository': {
-            #      'lastcheck': 'YYYY-MM-DD' or 'never',
-            #      'nextcheck': 'YYYY-MM-DD',
-            #      'lastrepack': 'YYYY-MM-DD',
-            #      'fingerprint': 'sha-1',
-            #      's_elapsed': seconds,
-            #      'quick_repack_count': times,
-            #    },
-            #    ...
-            #  }
-
-            status = json.loads(stfh.read())
-        except:
-            logger.critical('Failed to parse %s', statusfile)
-            lockf(flockh, LOCK_UN)
-            flockh.close()
-            return 1
-    else:
-        status = dict()
+    logger.info('   status: reading %s', statusfile)
+    status = read_status(statusfile)
+    if status is None:
+        grokmirror.manifest_unlock(manifile)
+        unlock_status(flockh)
+        return 1
 
     frequency = config['fsck'].getint('frequency', 30)
 
-    today = datetime.datetime.today()
-    todayiso = today.strftime('%F')
+    # All our dates are YYYY-MM-DD strings, which compare correctly as-is,
+    # so we never need to parse them back into dates
+    today = datetime.date.today()
+    todayiso = today.isoformat()
 
     if force:
         # Use randomization for next check, again
@@ -585,29 +731,32 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
         logger.info('Git version too old to support commit graphs, disabling')
         config['fsck']['commitgraph'] = 'no'
 
-    # Go through the manifest and compare with status
+    # Go through the manifest and compare with status. This is the only pass we make
+    # over the manifest -- the analysis below works off the entries we collect here.
     toplevel = os.path.realpath(config['core'].get('toplevel'))
+    obstdir = os.path.realpath(config['core'].get('objstore'))
     changed = False
+    # Only rewrite the status file if we actually changed anything in it
+    dirty = False
+    repo_entries = list()
     for gitdir in list(manifest):
         fullpath = os.path.join(toplevel, gitdir.lstrip('/'))
         # Does it exist?
         if not os.path.isdir(fullpath):
             # Remove it from manifest and status
             manifest.pop(gitdir)
-            try:
-                status.pop(fullpath)
-            except KeyError:
-                pass
+            if status.pop(fullpath, None) is not None:
+                dirty = True
             changed = True
             continue
 
-        if fullpath not in status.keys():
+        repo_entries.append((fullpath, '/' + gitdir.lstrip('/')))
+        if fullpath not in status:
             # Newly added repository
             if not force:
                 # Randomize next check between now and frequency
                 delay = random.randint(0, frequency)
-                nextdate = today + datetime.timedelta(days=delay)
-                nextcheck = nextdate.strftime('%F')
+                nextcheck = (today + datetime.timedelta(days=delay)).isoformat()
             else:
                 nextcheck = todayiso
 
@@ -616,23 +765,35 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 'nextcheck': nextcheck,
                 'fingerprint': grokmirror.get_repo_fingerprint(toplevel, gitdir),
             }
+            dirty = True
             logger.info('%s:', fullpath)
             logger.info('    added: next check on %s', nextcheck)
 
     if 'manifest' in config:
         pretty = config['manifest'].getboolean('pretty', False)
+        compresslevel = config['manifest'].getint('compresslevel', 6)
     else:
         pretty = False
+        compresslevel = 6
 
     if changed:
-        grokmirror.write_manifest(manifile, manifest, pretty=pretty)
+        grokmirror.write_manifest(manifile, manifest, pretty=pretty, compresslevel=compresslevel)
 
     grokmirror.manifest_unlock(manifile)
 
+    # Drop any status entries for repos that are no longer in the manifest.
+    # We do obstrepos separately below, so leave those alone.
+    known = set(x[0] for x in repo_entries)
+    for fullpath in list(status):
+        if fullpath not in known and not grokmirror.is_obstrepo(fullpath, obstdir):
+            logger.debug('%s is gone, no longer in manifest', fullpath)
+            status.pop(fullpath)
+            dirty = True
+
     # record newly found repos in the status file
-    logger.debug('Updating status file in %s', statusfile)
-    with open(statusfile, 'w') as stfh:
-        stfh.write(json.dumps(status, indent=2))
+    if dirty:
+        write_status(statusfile, status)
+        dirty = False
 
     # Go through status and find all repos that need work done on them.
     to_process = set()
@@ -645,7 +806,6 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
     # Can be "always", which is why we don't getboolean
     cfg_precious = config['fsck'].get('precious', 'yes')
 
-    obstdir = os.path.realpath(config['core'].get('objstore'))
     logger.info('   search: getting parent commit info from all repos, may take a while')
     top_roots, obst_roots = grokmirror.get_rootsets(toplevel, obstdir)
     amap = grokmirror.get_altrepo_map(toplevel)
@@ -654,29 +814,16 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
     obst_changes = False
     analyzed = 0
     queued = 0
-    logger.info('Analyzing %s (%s repos)', toplevel, len(status))
+    logger.info('Analyzing %s (%s repos)', toplevel, len(repo_entries))
     stattime = time.time()
     baselines = [x.strip() for x in config['fsck'].get('baselines', '').split('\n')]
-    for fullpath in list(status):
+    for fullpath, gitdir in repo_entries:
         # Give me a status every 5 seconds
         if time.time() - stattime >= 5:
-            logger.info('      ---: %s/%s analyzed, %s queued', analyzed, len(status), queued)
+            logger.info('      ---: %s/%s analyzed, %s queued', analyzed, len(repo_entries), queued)
             stattime = time.time()
         start_size = get_repo_size(fullpath)
         analyzed += 1
-        # We do obstrepos separately below, as logic is different
-        if grokmirror.is_obstrepo(fullpath, obstdir):
-            logger.debug('Skipping %s (obstrepo)')
-            continue
-
-        # Check to make sure it's still in the manifest
-        gitdir = fullpath.replace(toplevel, '', 1)
-        gitdir = '/' + gitdir.lstrip('/')
-
-        if gitdir not in manifest:
-            status.pop(fullpath)
-            logger.debug('%s is gone, no longer in manifest', gitdir)
-            continue
 
         # Make sure FETCH_HEAD is pointing to /dev/null
         fetch_headf = os.path.join(fullpath, 'FETCH_HEAD')
@@ -698,6 +845,25 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
         else:
             m_prune = True
 
+        # We no longer hold the status lock here, so another grok-fsck may be checking
+        # or repacking these repos right now. Migrating rewrites alternates and repacks,
+        # so leave the repo alone until the next run if it's busy.
+        to_lock = list()
+        if not altdir and not os.path.exists(os.path.join(fullpath, 'grokmirror.do-not-objstore')):
+            to_lock.append(fullpath)
+        elif altdir and os.path.isdir(altdir) and altdir.find(obstdir) != 0:
+            to_lock += [fullpath, altdir]
+        locked = list()
+        try:
+            for lockpath in to_lock:
+                grokmirror.lock_repo(lockpath, nonblocking=True)
+                locked.append(lockpath)
+        except IOError:
+            logger.info('     busy: %s (locked, skipping for now)', gitdir)
+            for lockpath in locked:
+                grokmirror.unlock_repo(lockpath)
+            continue
+
         if not altdir and not os.path.exists(os.path.join(fullpath, 'grokmirror.do-not-objstore')):
             # Do we match any obstdir repos?
             obstrepo = grokmirror.find_best_obstrepo(fullpath, obst_roots, toplevel, baselines)
@@ -727,6 +893,9 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                             # Are you a private repo?
                             if grokmirror.is_private_repo(config, top_sibling):
                                 continue
+                            # Or one we can't fetch all objects from?
+                            if os.path.exists(os.path.join(top_sibling, 'grokmirror.do-not-objstore')):
+                                continue
                             # Great, make an objstore repo out of this sibling
                             obstrepo = grokmirror.setup_objstore_repo(obstdir)
                             logger.info('%s: can use %s', gitdir, os.path.basename(obstrepo))
@@ -845,16 +1014,20 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 grokmirror.add_repo_to_objstore(obstrepo, fullpath)
                 logger.info(' reconfig: %s to fetch into %s', gitdir, os.path.basename(obstrepo))
 
+        for lockpath in locked:
+            grokmirror.unlock_repo(lockpath)
+
         obj_info = grokmirror.get_repo_obj_info(fullpath)
         try:
             packs = int(obj_info['packs'])
             count_loose = int(obj_info['count'])
         except KeyError:
-            logger.warning('Unable to count objects in %s, skipping' % fullpath)
+            logger.warning('Unable to count objects in %s, skipping', fullpath)
             continue
 
-        schedcheck = datetime.datetime.strptime(status[fullpath]['nextcheck'], '%Y-%m-%d')
-        nextcheck = today + datetime.timedelta(days=checkdelay)
+        schedcheck = status[fullpath]['nextcheck']
+        nextcheck = (today + datetime.timedelta(days=checkdelay)).isoformat()
+        fpchanged = status[fullpath].get('fingerprint') != grokmirror.get_repo_fingerprint(toplevel, gitdir)
 
         if not cfg_repack:
             # don't look at me if you turned off repack
@@ -866,16 +1039,17 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
         elif repack_all_quick and count_loose > 0:
             logger.debug('repack_level=1 due to repack_all_quick')
             repack_level = 1
-        elif status[fullpath].get('fingerprint') != grokmirror.get_repo_fingerprint(toplevel, gitdir):
+        elif fpchanged:
             logger.debug('Checking repack level of %s', fullpath)
             repack_level = grokmirror.get_repack_level(obj_info)
         else:
             repack_level = None
 
         # trigger a level-1 repack if it's regular check time and the fingerprint has changed
-        if (not repack_level and schedcheck <= today
-                and status[fullpath].get('fingerprint') != grokmirror.get_repo_fingerprint(toplevel, gitdir)):
-            status[fullpath]['nextcheck'] = nextcheck.strftime('%F')
+        if not repack_level and schedcheck <= todayiso and fpchanged:
+            if schedcheck != nextcheck:
+                status[fullpath]['nextcheck'] = nextcheck
+                dirty = True
             logger.info('     aged: %s (forcing repack)', fullpath)
             repack_level = 1
 
@@ -894,9 +1068,11 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
             # schedule as fsck.
             logger.debug('preciousObjects is set')
             # for repos with preciousObjects, we use the fsck schedule for repacking
-            if schedcheck <= today:
+            if schedcheck <= todayiso:
                 logger.debug('Time for a full periodic repack of a preciousObjects repo')
-                status[fullpath]['nextcheck'] = nextcheck.strftime('%F')
+                if status[fullpath]['nextcheck'] != nextcheck:
+                    status[fullpath]['nextcheck'] = nextcheck
+                    dirty = True
                 repack_level = 2
             else:
                 logger.debug('Not repacking preciousObjects repo outside of schedule')
@@ -911,7 +1087,7 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 logger.info('   queued: %s (repack)', fullpath)
         elif repack_only or repack_all_quick or repack_all_full:
             continue
-        elif schedcheck <= today or force:
+        elif schedcheck <= todayiso or force:
             queued += 1
             to_process.add((fullpath, 'fsck', None))
             logger.info('   queued: %s (fsck)', fullpath)
@@ -951,9 +1127,10 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 siblings.add(obstrepo)
                 mdest = merge_siblings(siblings, amap)
                 obst_changes = True
-                if mdest in status:
+                if mdest in status and status[mdest]['nextcheck'] != todayiso:
                     # Force full repack of merged obstrepos
                     status[mdest]['nextcheck'] = todayiso
+                    dirty = True
 
                 # Recalculate my roots
                 my_roots = grokmirror.get_repo_roots(obstrepo, force=True)
@@ -1094,14 +1271,15 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 'nextcheck': todayiso,
                 'fingerprint': None,
             }
+            dirty = True
             # Always full-repack brand new obstrepos
             repack_level = 2
         else:
             obj_info = grokmirror.get_repo_obj_info(obstrepo)
             repack_level = grokmirror.get_repack_level(obj_info)
 
-        nextcheck = datetime.datetime.strptime(status[obstrepo]['nextcheck'], '%Y-%m-%d')
-        if repack_level > 1 and nextcheck > today:
+        nextcheck = status[obstrepo]['nextcheck']
+        if repack_level > 1 and nextcheck > todayiso:
             # Don't do full repacks outside of schedule
             repack_level = 1
 
@@ -1114,9 +1292,8 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 logger.info('   queued: %s (repack)', os.path.basename(obstrepo))
         elif repack_only or repack_all_quick or repack_all_full:
             continue
-        elif (nextcheck <= today or force) and not repack_only:
+        elif (nextcheck <= todayiso or force) and not repack_only:
             queued += 1
-            status[obstrepo]['nextcheck'] = nextcheck.strftime('%F')
             to_process.add((obstrepo, 'fsck', None))
             logger.info('   queued: %s (fsck)', os.path.basename(obstrepo))
 
@@ -1137,9 +1314,15 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
             if 'forkgroup' in manifest[gitdir]:
                 disk_manifest[gitdir]['forkgroup'] = manifest[gitdir]['forkgroup']
 
-        grokmirror.write_manifest(manifile, disk_manifest, pretty=pretty)
+        grokmirror.write_manifest(manifile, disk_manifest, pretty=pretty, compresslevel=compresslevel)
         grokmirror.manifest_unlock(manifile)
 
+    # Record what we've found and let go of the status lock for the duration of
+    # the actual work
+    if dirty:
+        write_status(statusfile, status)
+    unlock_status(flockh)
+
     if not len(to_process):
         logger.info('No repos need attention.')
         return
@@ -1151,12 +1334,17 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
     gc.collect()
 
     logger.info('Processing %s repositories', len(to_process))
+    touched = set()
+    # Repos that got a full fsck during this run
+    checked = set()
 
-    for fullpath, action, repack_level in to_process:
+    # Do repos that don't borrow objects from anywhere first, so any repos using them
+    # for alternates don't have to verify the same objects again
+    for fullpath, action, repack_level in sorted(to_process, key=lambda x: grokmirror.get_altrepo(x[0]) is not None):
         logger.info('%s:', fullpath)
         start_size = get_repo_size(fullpath)
         checkdelay = frequency if not force else random.randint(1, frequency)
-        nextcheck = today + datetime.timedelta(days=checkdelay)
+        nextcheck = (today + datetime.timedelta(days=checkdelay)).isoformat()
 
         # Calculate elapsed seconds
         startt = time.time()
@@ -1165,6 +1353,12 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
         # otherwise there may be false-positives if a mirrored repo is updated
         # in the middle of fsck or repack.
         grokmirror.lock_repo(fullpath, nonblocking=False)
+        if is_done_elsewhere(statusfile, status, fullpath, action, todayiso):
+            logger.info('     skip: already done by another grok-fsck run')
+            grokmirror.unlock_repo(fullpath)
+            total_checked += 1
+            continue
+
         if action == 'repack':
             if run_git_repack(fullpath, config, repack_level):
                 status[fullpath]['lastrepack'] = todayiso
@@ -1176,7 +1370,7 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
 
                     status[fullpath]['lastfullrepack'] = todayiso
                     status[fullpath]['lastcheck'] = todayiso
-                    status[fullpath]['nextcheck'] = nextcheck.strftime('%F')
+                    status[fullpath]['nextcheck'] = nextcheck
                     # Do we need to generate a preload bundle?
                     if config['fsck'].get('preload_bundle_outdir') and grokmirror.is_obstrepo(fullpath, obstdir):
                         gen_preload_bundle(fullpath, config)
@@ -1187,9 +1381,9 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
                 continue
 
         elif action == 'fsck':
-            run_git_fsck(fullpath, config, conn_only)
+            run_git_fsck(fullpath, config, conn_only, checked=checked)
             status[fullpath]['lastcheck'] = todayiso
-            status[fullpath]['nextcheck'] = nextcheck.strftime('%F')
+            status[fullpath]['nextcheck'] = nextcheck
             logger.info('     next: %s', status[fullpath]['nextcheck'])
 
         gitdir = '/' + os.path.relpath(fullpath, toplevel)
@@ -1199,6 +1393,13 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
         elapsed = int(time.time()-startt)
         status[fullpath]['s_elapsed'] = elapsed
 
+        # Write status file after each check, so if the process dies, we won't
+        # have to recheck all the repos we've already checked. Do it before letting
+        # go of the repo, so another grok-fsck waiting on it sees that it's done.
+        touched.add(fullpath)
+        if merge_status(statusfile, lockfile, status, touched, attempts=1):
+            touched = set()
+
         # We're done with the repo now
         grokmirror.unlock_repo(fullpath)
         total_checked += 1
@@ -1215,19 +1416,10 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
         else:
             logger.info('      ---: %s done, %s queued', total_checked, len(to_process)-total_checked)
 
-        # Write status file after each check, so if the process dies, we won't
-        # have to recheck all the repos we've already checked
-        logger.debug('Updating status file in %s', statusfile)
-        with open(statusfile, 'w') as stfh:
-            stfh.write(json.dumps(status, indent=2))
-
     logger.info('Processed %s repos in %0.2fs', total_checked, total_elapsed)
 
-    with open(statusfile, 'w') as stfh:
-        stfh.write(json.dumps(status, indent=2))
-
-    lockf(flockh, LOCK_UN)
-    flockh.close()
+    if touched and not merge_status(statusfile, lockfile, status, touched, attempts=12):
+        logger.critical('Could not lock %s to record results', statusfile)
 
 
 def parse_args():
@@ -1298,6 +1490,8 @@ def grok_fsck(cfgfile, verbose=False, force=False, repack_only=False, conn_only=
 
     report = rh.getvalue()
     if len(report):
+        import smtplib
+        from email.message import EmailMessage
         msg = EmailMessage()
         msg.set_content(report)
         subject = config['fsck'].get('report_subject')
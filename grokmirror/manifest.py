@@ -21,67 +21,181 @@ import datetime
 
 import grokmirror
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice
+
 logger = logging.getLogger(__name__)
 
 objstore_uses_plumbing = False
 
 
-def update_manifest(manifest, toplevel, fullpath, usenow, ignorerefs):
-    logger.debug('Examining %s', fullpath)
-    if not grokmirror.is_bare_git_repo(fullpath):
-        logger.critical('Error opening %s.', fullpath)
-        logger.critical('Make sure it is a bare git repository.')
-        sys.exit(1)
+def get_gitdir(toplevel, fullpath):
+    # Same as '/' + os.path.relpath(fullpath, toplevel), but much cheaper for
+    # the usual case of a normalized path inside toplevel
+    if (fullpath.startswith(toplevel + '/') and not fullpath.endswith('/')
+            and fullpath.find('//') < 0 and fullpath.find('/.') < 0):
+        return fullpath[len(toplevel):]
+    return '/' + os.path.relpath(fullpath, toplevel)
+
 
-    gitdir = '/' + os.path.relpath(fullpath, toplevel)
+def get_repoinfo(toplevel, usenow, ignorerefs, fullpath):
+    logger.debug('Examining %s', fullpath)
+    gitdir = get_gitdir(toplevel, fullpath)
     repoinfo = grokmirror.get_repo_defs(toplevel, gitdir, usenow=usenow, ignorerefs=ignorerefs)
+    # Hand back the altrepo too, so the parent doesn't have to read it again
+    return fullpath, grokmirror.get_altrepo(fullpath), repoinfo
+
+
+def probe_gitdir(check_export_ok, links, gitdir):
+    exported = not check_export_ok or os.path.exists(os.path.join(gitdir, 'git-daemon-export-ok'))
+    return gitdir, exported, gitdir in links
+
+
+def iter_probes(gitdirs, check_export_ok, links):
+    # These are just stat calls, but they add up on NFS, so overlap them in
+    # threads when there are many paths to look at
+    prober = partial(probe_gitdir, check_export_ok, links)
+    if len(gitdirs) < 2:
+        yield from map(prober, gitdirs)
+        return
+
+    with ThreadPoolExecutor() as executor:
+        yield from executor.map(prober, gitdirs)
+
+
+def iter_walk(toplevel, ignore, check_export_ok, found):
+    # Probe repos as the tree walk finds them, instead of waiting for the
+    # walk to finish, and remember what we found for purging later. The walk
+    # already knows which repos are symlinks, so we don't need to ask again.
+    symlinks = set()
+    for gitdir in grokmirror.iter_gitdirs(toplevel, ignore=ignore, exclude_objstore=True, symlinks=symlinks):
+        found.add(gitdir)
+        exported = not check_export_ok or os.path.exists(os.path.join(gitdir, 'git-daemon-export-ok'))
+        yield gitdir, exported, gitdir in symlinks
+
+
+def init_worker(logfile, loglevel, verbose):
+    # Forked workers inherit the parent's log handlers, but spawned ones don't
+    if not logging.getLogger('grokmirror').handlers:
+        grokmirror.init_logger('manifest', logfile, loglevel, verbose)
+
+
+def get_repoinfo_worker(logargs, toplevel, usenow, ignorerefs, fullpath):
+    # ProcessPoolExecutor only takes an initializer since python-3.7, so set
+    # up logging here instead (it's a no-op once the handlers are there)
+    init_worker(*logargs)
+    return get_repoinfo(toplevel, usenow, ignorerefs, fullpath)
+
+
+def iter_repoinfo(toplevel, fullpaths, usenow, ignorerefs, jobs=None, logargs=(None, logging.INFO, False)):
+    # Getting repo info shells out to git several times per repo, so spread
+    # the work across processes when we have more than one repo to look at.
+    # Results come back in the same order as fullpaths.
+    # The workers start as soon as the first paths come in, even if fullpaths
+    # is a generator that is still walking the tree.
+    getter = partial(get_repoinfo, toplevel, usenow, ignorerefs)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    fullpaths = iter(fullpaths)
+    first = list(islice(fullpaths, 2))
+    if jobs < 2 or len(first) < 2:
+        yield from map(getter, chain(first, fullpaths))
+        return
+
+    getter = partial(get_repoinfo_worker, logargs, toplevel, usenow, ignorerefs)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(getter, chain(first, fullpaths), chunksize=16)
+
+
+def update_manifest(manifest, toplevel, fullpath, altrepo, repoinfo, refcache=None):
+    gitdir = get_gitdir(toplevel, fullpath)
     # Ignore it if it's an empty git repository
     if not repoinfo['fingerprint']:
         logger.info(' manifest: ignored %s (no heads)', gitdir)
         return
 
     if gitdir not in manifest:
-        # In grokmirror-1.x we didn't normalize paths to be always with a leading '/', so
-        # check the manifest for both and make sure we only save the path with a leading /
-        if gitdir.lstrip('/') in manifest:
-            manifest[gitdir] = manifest.pop(gitdir.lstrip('/'))
-            logger.info(' manifest: updated %s', gitdir)
-        else:
-            logger.info(' manifest: added %s', gitdir)
-            manifest[gitdir] = dict()
+        logger.info(' manifest: added %s', gitdir)
+        manifest[gitdir] = dict()
     else:
         logger.info(' manifest: updated %s', gitdir)
 
-    altrepo = grokmirror.get_altrepo(fullpath)
     reference = None
     if manifest[gitdir].get('forkgroup', None) != repoinfo.get('forkgroup', None):
         # Use the first remote listed in the forkgroup as our reference, just so
         # grokmirror-1.x clients continue to work without doing full clones
-        remotes = grokmirror.list_repo_remotes(altrepo, withurl=True)
-        if len(remotes):
-            urls = list(x[1] for x in remotes)
-            urls.sort()
-            reference = '/' + os.path.relpath(urls[0], toplevel)
+        # All forks in an objstore get the same answer, so only ask git once
+        # per objstore repo during this run
+        if refcache is not None and altrepo in refcache:
+            reference = refcache[altrepo]
+        else:
+            remotes = grokmirror.list_repo_remotes(altrepo, withurl=True)
+            if len(remotes):
+                urls = list(x[1] for x in remotes)
+                urls.sort()
+                reference = get_gitdir(toplevel, urls[0])
+            if refcache is not None:
+                refcache[altrepo] = reference
     else:
         reference = manifest[gitdir].get('reference', None)
 
     if altrepo and not reference and not repoinfo.get('forkgroup'):
         # Not an objstore repo
-        reference = '/' + os.path.relpath(altrepo, toplevel)
+        reference = get_gitdir(toplevel, altrepo)
 
     manifest[gitdir].update(repoinfo)
     # Always write a reference entry even if it's None, as grok-1.x clients expect it
     manifest[gitdir]['reference'] = reference
 
 
+def resolve_symlink(path, dircache, depth=0):
+    # Like os.path.realpath, but remembers resolved parent directories, since
+    # most symlinks in a tree share them and realpath lstats every component
+    dirname, basename = os.path.split(path)
+    if dirname not in dircache:
+        dircache[dirname] = os.path.realpath(dirname)
+    fullpath = os.path.join(dircache[dirname], basename)
+    if basename in ('', '.', '..') or depth > 40:
+        return os.path.realpath(fullpath)
+    try:
+        link = os.readlink(fullpath)
+    except OSError:
+        # Not a symlink, or does not exist
+        return fullpath
+    return resolve_symlink(os.path.join(dircache[dirname], link), dircache, depth + 1)
+
+
+def copy_manifest(manifest):
+    # Symlink lists are the only values we change in place
+    snapshot = dict()
+    for gitdir, repoinfo in manifest.items():
+        snapshot[gitdir] = dict(repoinfo)
+        if 'symlinks' in repoinfo:
+            snapshot[gitdir]['symlinks'] = list(repoinfo['symlinks'])
+    return snapshot
+
+
 def set_symlinks(manifest, toplevel, symlinks):
+    # Index repos by their reference, so fixing up references for each symlink
+    # doesn't require going through the whole manifest
+    by_reference = dict()
+    for gitdir, repoinfo in manifest.items():
+        reference = repoinfo.get('reference')
+        if not reference:
+            continue
+        if reference not in by_reference:
+            by_reference[reference] = list()
+        by_reference[reference].append(gitdir)
+
+    dircache = dict()
     for symlink in symlinks:
-        target = os.path.realpath(symlink)
+        target = resolve_symlink(symlink, dircache)
         if not os.path.exists(target):
             logger.critical(' manifest: symlink %s is broken, ignored', symlink)
             continue
         relative = '/' + os.path.relpath(symlink, toplevel)
-        if target.find(toplevel) < 0:
+        if os.path.commonpath([target, toplevel]) != toplevel:
             logger.critical(' manifest: symlink %s points outside toplevel, ignored', relative)
             continue
         tgtgitdir = '/' + os.path.relpath(target, toplevel)
@@ -98,23 +212,44 @@ def set_symlinks(manifest, toplevel, symlinks):
             manifest[tgtgitdir]['symlinks'] = [relative]
             logger.info(' manifest: symlinked %s->%s', relative, tgtgitdir)
 
-        # Now go through all repos and fix any references pointing to the
-        # symlinked location. We shouldn't need to do anything with forkgroups.
-        for gitdir in manifest:
-            if manifest[gitdir] == relative:
-                logger.info(' manifest: removing %s (replaced by a symlink)', gitdir)
-                manifest.pop(gitdir)
+        # Now fix any repos that are replaced by this symlink or use it as their
+        # reference. We shouldn't need to do anything with forkgroups.
+        if relative in manifest:
+            logger.info(' manifest: removing %s (replaced by a symlink)', relative)
+            manifest.pop(relative)
+        for gitdir in by_reference.pop(relative, list()):
+            if gitdir not in manifest:
                 continue
-            if manifest[gitdir]['reference'] == relative:
-                logger.info(' manifest: symlinked %s->%s', relative, tgtgitdir)
-                manifest[gitdir]['reference'] = tgtgitdir
+            logger.info(' manifest: symlinked %s->%s', relative, tgtgitdir)
+            manifest[gitdir]['reference'] = tgtgitdir
+            if tgtgitdir not in by_reference:
+                by_reference[tgtgitdir] = list()
+            by_reference[tgtgitdir].append(gitdir)
 
 
 def purge_manifest(manifest, toplevel, gitdirs):
+    known = set(get_gitdir(toplevel, x) for x in gitdirs)
     for oldrepo in list(manifest):
-        if os.path.join(toplevel, oldrepo.lstrip('/')) not in gitdirs:
+        # Manifest keys are normally already in this form, so only build a
+        # normalized copy when the straight lookup misses
+        if oldrepo not in known and '/' + oldrepo.lstrip('/') not in known:
             logger.info(' manifest: purged %s (gone)', oldrepo)
-            manifest.remove(oldrepo)
+            manifest.pop(oldrepo)
+
+
+def fetch_objstore(item):
+    altrepo, gitdirs = item
+    try:
+        grokmirror.lock_repo(altrepo, nonblocking=True)
+    except IOError:
+        # grok-fsck will fetch this one, then
+        return
+    # Each repo is a separate remote in the objstore repo, so we need to fetch
+    # from all of them, but we only need to take the lock once
+    for gitdir in gitdirs:
+        logger.info(' manifest: objstore %s -> %s', gitdir, os.path.basename(altrepo))
+        grokmirror.fetch_objstore_repo(altrepo, gitdir, use_plumbing=objstore_uses_plumbing)
+    grokmirror.unlock_repo(altrepo)
 
 
 def parse_args():
@@ -163,9 +298,13 @@ def parse_args():
     op.add_argument('-o', '--fetch-objstore', dest='fetchobst',
                     action='store_true', default=False,
                     help='Fetch updates into objstore repo (if used)')
+    op.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                    help='Number of processes to use when examining repositories (default: number of CPUs)')
     op.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                     default=False,
                     help='Be verbose and tell us what you are doing')
+    op.add_argument('-z', '--compress-level', dest='compresslevel', type=int, default=None,
+                    help='Gzip compression level to use when writing the manifest (default: 6)')
     op.add_argument('--version', action='version', version=grokmirror.VERSION)
     op.add_argument('paths', nargs='*', help='Full path(s) to process')
 
@@ -191,6 +330,10 @@ def parse_args():
                 opts.pretty = config['manifest'].getboolean('pretty', False)
             if not opts.fetchobst:
                 opts.fetchobst = config['manifest'].getboolean('fetch_objstore', False)
+            if opts.jobs is None:
+                opts.jobs = config['manifest'].getint('jobs', None)
+            if opts.compresslevel is None:
+                opts.compresslevel = config['manifest'].getint('compresslevel', None)
 
     if not opts.manifile:
         op.error('You must provide the path to the manifest file')
@@ -198,6 +341,12 @@ def parse_args():
         op.error('You must provide the toplevel path')
     if opts.ignore is None:
         opts.ignore = list()
+    if opts.compresslevel is None:
+        opts.compresslevel = 6
+    elif not 0 <= opts.compresslevel <= 9:
+        op.error('Compression level must be between 0 and 9')
+    if opts.jobs is not None and opts.jobs < 1:
+        op.error('Number of jobs must be at least 1')
 
     if not len(opts.paths) and opts.wait:
         op.error('--wait option only makes sense when dirs are passed')
@@ -208,7 +357,7 @@ def parse_args():
 def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
                   check_export_ok=False, purge=False, remove=False,
                   pretty=False, ignore=None, wait=False, verbose=False, fetchobst=False,
-                  ignorerefs=None):
+                  ignorerefs=None, jobs=None, compresslevel=6):
     global logger
     loglevel = logging.INFO
     logger = grokmirror.init_logger('manifest', logfile, loglevel, verbose)
@@ -221,6 +370,15 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
 
     grokmirror.manifest_lock(manifile)
     manifest = grokmirror.read_manifest(manifile, wait=wait)
+    # Remember what we started with, so we don't rewrite the manifest (and make
+    # all mirrors download it again) when nothing in it has changed
+    origmanifest = copy_manifest(manifest)
+    # In grokmirror-1.x we didn't normalize paths to be always with a leading '/',
+    # so fix up any such entries once here instead of checking for each repo
+    for gitdir in [x for x in manifest if not x.startswith('/')]:
+        repoinfo = manifest.pop(gitdir)
+        if '/' + gitdir not in manifest:
+            manifest['/' + gitdir] = repoinfo
 
     toplevel = os.path.realpath(toplevel)
 
@@ -229,6 +387,15 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
         usenow = False
 
     if remove and len(paths):
+        # Index symlinks by name, so we don't go through the whole
+        # manifest for each path that isn't a repo
+        by_symlink = dict()
+        for gitdir, repoinfo in manifest.items():
+            for symlink in repoinfo.get('symlinks', list()):
+                if symlink not in by_symlink:
+                    by_symlink[symlink] = list()
+                by_symlink[symlink].append(gitdir)
+
         # Remove the repos as required, write new manfiest and exit
         for fullpath in paths:
             repo = '/' + os.path.relpath(fullpath, toplevel)
@@ -238,90 +405,131 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
             else:
                 # Is it in any of the symlinks?
                 found = False
-                for gitdir in manifest:
-                    if 'symlinks' in manifest[gitdir] and repo in manifest[gitdir]['symlinks']:
-                        found = True
-                        manifest[gitdir]['symlinks'].remove(repo)
-                        if not len(manifest[gitdir]['symlinks']):
-                            manifest[gitdir].pop('symlinks')
-                        logger.info(' manifest: removed symlink %s->%s', repo, gitdir)
+                for gitdir in by_symlink.pop(repo, list()):
+                    if gitdir not in manifest:
+                        continue
+                    found = True
+                    manifest[gitdir]['symlinks'].remove(repo)
+                    if not len(manifest[gitdir]['symlinks']):
+                        manifest[gitdir].pop('symlinks')
+                    logger.info(' manifest: removed symlink %s->%s', repo, gitdir)
                 if not found:
                     logger.info(' manifest: %s not in manifest', repo)
 
         # XXX: need to add logic to make sure we don't break the world
         #      by removing a repository used as a reference for others
-        grokmirror.write_manifest(manifile, manifest, pretty=pretty)
+        if manifest != origmanifest:
+            grokmirror.write_manifest(manifile, manifest, pretty=pretty, compresslevel=compresslevel)
         grokmirror.manifest_unlock(manifile)
         return 0
 
-    gitdirs = list()
+    # iter_gitdirs already checked that these are git repos, so we don't
+    # need to probe them again before looking inside
+    found = set()
+    walked = list()
 
-    if purge or not len(paths) or not len(manifest):
-        # We automatically purge when we do a full tree walk
-        for gitdir in grokmirror.find_all_gitdirs(toplevel, ignore=ignore, exclude_objstore=True):
-            gitdirs.append(gitdir)
-        purge_manifest(manifest, toplevel, gitdirs)
+    # We automatically purge when we do a full tree walk
+    fullwalk = purge or not len(paths) or not len(manifest)
+    if fullwalk:
+        walked = iter_walk(toplevel, ignore, check_export_ok, found)
 
+    gitdirs = list()
+    links = set()
     if len(manifest) and len(paths):
         # limit ourselves to passed dirs only when there is something
         # in the manifest. This precaution makes sure we regenerate the
         # whole file when there is nothing in it or it can't be parsed.
+        # Passed paths usually share a parent, so only resolve that once
+        dircache = dict()
         for apath in paths:
-            arealpath = os.path.realpath(apath)
-            if apath != arealpath and os.path.islink(apath):
+            if os.path.islink(apath):
+                links.add(apath)
                 gitdirs.append(apath)
             else:
-                gitdirs.append(arealpath)
+                gitdirs.append(resolve_symlink(apath, dircache))
 
     symlinks = list()
-    tofetch = set()
-    for gitdir in gitdirs:
-        # check to make sure this gitdir is ok to export
-        if check_export_ok and not os.path.exists(os.path.join(gitdir, 'git-daemon-export-ok')):
-            # is it curently in the manifest?
-            repo = '/' + os.path.relpath(gitdir, toplevel)
-            if repo in list(manifest):
-                logger.info(' manifest: removed %s (no longer exported)', repo)
-                manifest.pop(repo)
 
-            # XXX: need to add logic to make sure we don't break the world
-            #      by removing a repository used as a reference for others
-            #      also make sure we clean up any dangling symlinks
-            continue
+    def iter_toupdate():
+        # We go through the paths we were passed after the walk is done,
+        # so we know which ones it already found
+        for gitdir, exported, islink in chain(walked, iter_probes(gitdirs, check_export_ok, links)):
+            # check to make sure this gitdir is ok to export
+            if not exported:
+                # is it curently in the manifest?
+                repo = get_gitdir(toplevel, gitdir)
+                if repo in manifest:
+                    logger.info(' manifest: removed %s (no longer exported)', repo)
+                    manifest.pop(repo)
+
+                # XXX: need to add logic to make sure we don't break the world
+                #      by removing a repository used as a reference for others
+                #      also make sure we clean up any dangling symlinks
+                continue
 
-        if os.path.islink(gitdir):
-            symlinks.append(gitdir)
-        else:
-            update_manifest(manifest, toplevel, gitdir, usenow, ignorerefs)
-            if fetchobst:
-                # Do it after we're done with manifest, to avoid keeping it locked
-                tofetch.add(gitdir)
+            if islink:
+                symlinks.append(gitdir)
+                continue
+
+            if gitdir not in found and not grokmirror.is_bare_git_repo(gitdir):
+                logger.critical('Error opening %s.', gitdir)
+                logger.critical('Make sure it is a bare git repository.')
+                sys.exit(1)
+
+            yield gitdir
+
+    logargs = (logfile, loglevel, verbose)
+    # If asked, we fetch into objstore repos after we're done with manifest,
+    # to avoid keeping it locked. We group them by objstore repo.
+    tofetch_obst = dict()
+    refcache = dict()
+    for gitdir, altrepo, repoinfo in iter_repoinfo(toplevel, iter_toupdate(), usenow, ignorerefs, jobs=jobs,
+                                                   logargs=logargs):
+        update_manifest(manifest, toplevel, gitdir, altrepo, repoinfo, refcache=refcache)
+        if not fetchobst or not altrepo:
+            continue
+        # Only fetch repos that have changed since they were last fetched into
+        # objstore, which may not have happened yet even if the manifest has them
+        if not repoinfo['fingerprint']:
+            continue
+        if grokmirror.get_objstore_fingerprint(altrepo, gitdir) == repoinfo['fingerprint']:
+            continue
+        if altrepo not in tofetch_obst:
+            if not grokmirror.is_obstrepo(altrepo):
+                continue
+            tofetch_obst[altrepo] = list()
+        tofetch_obst[altrepo].append(gitdir)
+
+    # Start fetching into objstore repos now, so it happens while we're writing
+    # out the manifest. Each job fetches into a different objstore repo, so
+    # they don't get in each other's way.
+    fetches = list()
+    if len(tofetch_obst):
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        for item in tofetch_obst.items():
+            fetches.append(executor.submit(fetch_objstore, item))
+        executor.shutdown(wait=False)
+
+    if fullwalk:
+        # Don't purge repos we were explicitly passed, even if the walk didn't find them
+        purge_manifest(manifest, toplevel, found.union(x for x in gitdirs if x not in links))
 
     if len(symlinks):
         set_symlinks(manifest, toplevel, symlinks)
 
-    grokmirror.write_manifest(manifile, manifest, pretty=pretty)
+    if manifest != origmanifest or not len(origmanifest):
+        grokmirror.write_manifest(manifile, manifest, pretty=pretty, compresslevel=compresslevel)
+    else:
+        logger.info(' manifest: no changes, not rewriting %s', manifile)
     grokmirror.manifest_unlock(manifile)
 
-    fetched = set()
-    for gitdir in tofetch:
-        altrepo = grokmirror.get_altrepo(gitdir)
-        if altrepo in fetched:
-            continue
-        if altrepo and grokmirror.is_obstrepo(altrepo):
-            try:
-                grokmirror.lock_repo(altrepo, nonblocking=True)
-                logger.info(' manifest: objstore %s -> %s', gitdir, os.path.basename(altrepo))
-                grokmirror.fetch_objstore_repo(altrepo, gitdir, use_plumbing=objstore_uses_plumbing)
-                grokmirror.unlock_repo(altrepo)
-                fetched.add(altrepo)
-            except IOError:
-                # grok-fsck will fetch this one, then
-                pass
+    for future in fetches:
+        future.result()
 
     elapsed = datetime.datetime.now() - startt
-    if len(gitdirs) > 1:
-        logger.info('Updated %s records in %ds', len(gitdirs), elapsed.total_seconds())
+    total = len(found) + len(gitdirs)
+    if total > 1:
+        logger.info('Updated %s records in %ds', total, elapsed.total_seconds())
     else:
         logger.info('Done in %0.2fs', elapsed.total_seconds())
 
@@ -334,7 +542,8 @@ def command():
         usenow=opts.usenow, check_export_ok=opts.check_export_ok,
         purge=opts.purge, remove=opts.remove, pretty=opts.pretty,
         ignore=opts.ignore, wait=opts.wait, verbose=opts.verbose,
-        fetchobst=opts.fetchobst, ignorerefs=opts.ignore_refs)
+        fetchobst=opts.fetchobst, ignorerefs=opts.ignore_refs, jobs=opts.jobs,
+        compresslevel=opts.compresslevel)
 
 
 if __name__ == '__main__':
@@ -3,88 +3,150 @@
 #
 # A hook to properly initialize and index mirrored public-inbox repositories.
 
+import hashlib
 import logging
 import os
 import sys
 import re
 import shutil
-import pathlib
 
 import grokmirror
 
-from fnmatch import fnmatch
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import translate
+from typing import Iterable, Optional, Tuple
 
 # default basic logger. We override it later.
 logger = logging.getLogger(__name__)
 
+# public-inbox repos end with .../git/N.git
+EPOCH_RE = re.compile(r'(/.*)/git/\d+\.git/?\Z')
+
+_boosts = dict()
+_realpaths = dict()
+
 
 def get_pi_repos(inboxdir: str) -> list:
+    # One readdir instead of an isdir() for every epoch
+    epochs = dict()
+    try:
+        with os.scandir(os.path.join(inboxdir, 'git')) as it:
+            for entry in it:
+                matches = re.fullmatch(r'(\d+)\.git', entry.name)
+                if matches and entry.is_dir():
+                    epochs[int(matches.group(1))] = entry.path
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+
     members = list()
     at = 0
-    while True:
-        repodir = os.path.join(inboxdir, 'git', '%d.git' % at)
-        if not os.path.isdir(repodir):
-            break
-        members.append(repodir)
+    # Stop at the first gap in epoch numbers
+    while at in epochs:
+        members.append(epochs[at])
         at += 1
 
     return members
 
 
-def index_pi_inbox(fullpath: str, opts) -> bool:
-    gdir, pdir = get_git_pi_dir(opts, fullpath)
-    logger.info('pi-index %s', gdir)
-    success = True
-    # Check that msgmap.sqlite3 is there
-    msgmapdbf = os.path.join(pdir, 'msgmap.sqlite3')
-    if not os.path.exists(msgmapdbf):
-        logger.info('Inboxdir not initialized: %s', pdir)
+def get_index_stamp(gdir: str) -> Optional[str]:
+    # Changes whenever refs change in any of the epochs, which is the only
+    # time public-inbox-index would have anything to do for a mirror
+    stamps = list()
+    for repo in get_pi_repos(gdir):
+        stamp = grokmirror.get_refs_stamp(repo)
+        if stamp is None:
+            return None
+        stamps.append(stamp)
+    if not stamps:
+        return None
+    return hashlib.sha1(' '.join(stamps).encode()).hexdigest()
+
+
+def is_index_current(pdir: str, stamp: Optional[str]) -> bool:
+    if stamp is None:
         return False
+    try:
+        return grokmirror.read_small_file(os.path.join(pdir, 'grokmirror.indexstamp')).decode().strip() == stamp
+    except IOError:
+        return False
+
 
+def set_index_stamp(pdir: str, stamp: Optional[str]) -> None:
+    if stamp is None:
+        return
+    with open(os.path.join(pdir, 'grokmirror.indexstamp'), 'w') as fh:
+        fh.write(stamp + '\n')
+
+
+def index_pi_inbox(fullpath: str, opts, nofsync: bool = False) -> bool:
+    return index_pi_inboxes([fullpath], opts, nofsync=nofsync)
+
+
+def index_pi_inboxes(fullpaths: list, opts, nofsync: bool = False) -> bool:
+    # public-inbox-index takes any number of inboxes, so we only pay for
+    # starting it up once. process_inboxdirs already made sure these are
+    # initialized, so we don't check for msgmap.sqlite3 again.
+    pdirs = list()
+    for fullpath in fullpaths:
+        gdir, pdir = get_git_pi_dir(opts, fullpath)
+        logger.info('pi-index %s', gdir)
+        pdirs.append(pdir)
+
+    success = True
     piargs = ['public-inbox-index', '--no-update-extindex']
     if opts.jobs:
         piargs += ['--jobs', str(opts.jobs)]
-    if opts.nofsync:
+    if opts.nofsync or nofsync:
         piargs += ['--no-fsync']
 
-    piargs.append(pdir)
+    piargs += pdirs
 
-    env = {
-        'PI_CONFIG': opts.piconfig,
-        'PATH': os.getenv('PATH', '/bin:/usr/bin:/usr/local/bin'),
-    }
+    env = get_pi_env(opts)
     try:
         ec, out, err = grokmirror.run_shell_command(piargs, env=env)
         if ec > 0:
-            logger.critical('Unable to index public-inbox repo %s: %s', pdir, err)
+            logger.critical('Unable to index public-inbox repo %s: %s', ', '.join(pdirs), err)
             success = False
     except Exception as ex:  # noqa
-        logger.critical('Unable to index public-inbox repo %s: %s', pdir, ex)
+        logger.critical('Unable to index public-inbox repo %s: %s', ', '.join(pdirs), ex)
         success = False
 
     return success
 
 
+def get_boosts(listid_priority: str) -> list:
+    # Compile the globs once, not for every listid we see in every inbox
+    if listid_priority not in _boosts:
+        boosts = list()
+        # for boost values, we look at the number of entries
+        for at, patt in enumerate(reversed(listid_priority.split(','))):
+            boosts.append((at + 10, re.compile(translate(patt))))
+        _boosts[listid_priority] = boosts
+    return _boosts[listid_priority]
+
+
 def init_pi_inbox(gdir: str, pdir: str, opts) -> bool:
-    # for boost values, we look at the number of entries
     boosts = list()
     if opts.listid_priority:
-        boosts = list(reversed(opts.listid_priority.split(',')))
+        boosts = get_boosts(opts.listid_priority)
 
     logger.info('pi-init  %s', gdir)
-    # Lock all member repos so they don't get updated in the process
+    # Lock member repos so they don't get updated in the process. We only lock
+    # the ones we look at for now, and the rest once we know we're going to
+    # run public-inbox-init.
     pi_repos = get_pi_repos(gdir)
     origins = None
     gitargs = ['show', 'refs/meta/origins:i']
     # We reverse because we want to give priority to the latest origins info
     success = True
+    locked = set()
     for subrepo in reversed(pi_repos):
         grokmirror.lock_repo(subrepo)
-        if not origins:
-            ec, out, err = grokmirror.run_git_command(subrepo, gitargs)
-            if out:
-                origins = out
+        locked.add(subrepo)
+        ec, out, err = grokmirror.run_git_command(subrepo, gitargs)
+        if out:
+            origins = out
+            break
     inboxname = os.path.basename(gdir)
     if not origins and opts.origin_host:
         # Attempt to grab the config sample from remote
@@ -92,7 +154,7 @@ def init_pi_inbox(gdir: str, pdir: str, opts) -> bool:
         rconfig = f'{origin_host}/{inboxname}/_/text/config/raw'
         try:
             ses = grokmirror.get_requests_session()
-            res = ses.get(rconfig)
+            res = ses.get(rconfig, timeout=(30, 300))
             res.raise_for_status()
             origins = res.text
         except: # noqa
@@ -117,7 +179,7 @@ def init_pi_inbox(gdir: str, pdir: str, opts) -> bool:
         addresses = list()
         for line in origins.split('\n'):
             line = line.strip()
-            if not line or line.startswith(';') or line.startswith('#') or line.startswith('[publicinbox'):
+            if not line or line.startswith((';', '#', '[publicinbox')):
                 continue
             try:
                 opt, val = line.split('=', maxsplit=1)
@@ -136,9 +198,9 @@ def init_pi_inbox(gdir: str, pdir: str, opts) -> bool:
                     listid = val
                     # Calculate the boost value
                     boostval = 1
-                    for patt in boosts:
-                        if fnmatch(val, patt):
-                            boostval = boosts.index(patt) + 10
+                    for boost, patt in boosts:
+                        if patt.match(val):
+                            boostval = boost
                             break
                     extraopts.append(('boost', str(boostval)))
 
@@ -162,12 +224,18 @@ def init_pi_inbox(gdir: str, pdir: str, opts) -> bool:
                 description = f'{inboxname} archive mirror'
 
         if success:
+            for subrepo in pi_repos:
+                if subrepo not in locked:
+                    grokmirror.lock_repo(subrepo)
+                    locked.add(subrepo)
             if gdir != pdir:
                 # public-inbox databases are separate from the main git trees
-                pathlib.Path(pdir).mkdir(parents=True, exist_ok=True)
-                # Symlink the git subpath
-                if not os.path.islink(os.path.join(pdir, 'git')):
+                os.makedirs(pdir, exist_ok=True)
+                # Symlink the git subpath, unless it's already there
+                try:
                     os.symlink(os.path.join(gdir, 'git'), os.path.join(pdir, 'git'))
+                except FileExistsError:
+                    pass
 
             # Now we run public-inbox-init
             piargs = ['public-inbox-init', '-V2', '-L', opts.indexlevel]
@@ -179,10 +247,7 @@ def init_pi_inbox(gdir: str, pdir: str, opts) -> bool:
             piargs += addresses
             logger.debug('piargs=%s', piargs)
 
-            env = {
-                'PI_CONFIG': opts.piconfig,
-                'PATH': os.getenv('PATH', '/bin:/usr/bin:/usr/local/bin'),
-            }
+            env = get_pi_env(opts)
             try:
                 ec, out, err = grokmirror.run_shell_command(piargs, env=env)
                 if ec > 0:
@@ -196,20 +261,19 @@ def init_pi_inbox(gdir: str, pdir: str, opts) -> bool:
             with open(os.path.join(pdir, 'description'), 'w') as fh:
                 fh.write(description)
 
-    # Unlock all members
-    for subrepo in pi_repos:
+    # Unlock all members we locked
+    for subrepo in locked:
         grokmirror.unlock_repo(subrepo)
 
     return success
 
 
-def get_inboxdirs(repos: list) -> set:
+def get_inboxdirs(repos: Iterable[str]) -> set:
     inboxdirs = set()
     for repo in repos:
-        # Check that it's a public-inbox repo -- it should have .../git/N.git at the end
-        matches = re.search(r'(/.*)/git/\d+\.git', repo)
+        matches = EPOCH_RE.search(repo)
         if matches:
-            inboxdirs.add(matches.groups()[0])
+            inboxdirs.add(matches.group(1))
 
     return inboxdirs
 
@@ -219,34 +283,105 @@ def process_inboxdirs(inboxdirs: set, opts, init: bool = False):
         logger.info('Nothing to do')
         sys.exit(0)
 
-    # Init all new repos first, and then index them one by one
-    toindex = set()
+    # Init all new repos first, and then index them. We remember the refs
+    # we've indexed, so we can skip inboxes that haven't changed since.
+    toindex = dict()
+    newindex = dict()
     for inboxdir in inboxdirs:
         gdir, pdir = get_git_pi_dir(opts, inboxdir)
         # Check if msgmap.sqlite3 is there -- it can be a clone of a new epoch,
         # so no initialization is necessary
         msgmapdbf = os.path.join(pdir, 'msgmap.sqlite3')
-        if init and not os.path.exists(msgmapdbf):
+        initialized = os.path.exists(msgmapdbf)
+        if init and not initialized:
             # Initialize this public-inbox repo
             if not init_pi_inbox(gdir, pdir, opts):
                 logger.critical('Could not init %s', inboxdir)
                 continue
-        if os.path.exists(msgmapdbf):
-            toindex.add(inboxdir)
-
-    for inboxdir in toindex:
-        if not index_pi_inbox(inboxdir, opts):
+            if os.path.exists(msgmapdbf):
+                # A stamp left over from before a re-init doesn't count
+                newindex[inboxdir] = get_index_stamp(gdir)
+            continue
+        if not initialized:
+            continue
+        stamp = get_index_stamp(gdir)
+        if is_index_current(pdir, stamp):
+            logger.info('pi-index %s is up to date', gdir)
+            continue
+        toindex[inboxdir] = stamp
+
+    if len(newindex):
+        # The first indexing run of a new inbox is by far the heaviest, so don't
+        # fsync every write and sync everything once at the end instead. If the
+        # system goes down in the middle, the inbox may need --force-reinit.
+        indexed = run_index(list(newindex), opts, nofsync=True)
+        if len(indexed):
+            os.sync()
+        for inboxdir in indexed:
+            set_index_stamp(get_git_pi_dir(opts, inboxdir)[1], newindex[inboxdir])
+
+    for inboxdir in run_index(list(toindex), opts):
+        set_index_stamp(get_git_pi_dir(opts, inboxdir)[1], toindex[inboxdir])
+
+
+def run_index(inboxdirs: list, opts, nofsync: bool = False) -> list:
+    # Returns the inboxdirs we've successfully indexed
+    if opts.parallel > 1 and len(inboxdirs) > 1:
+        # public-inbox-index does its work in a separate process, so threads
+        # are enough to keep several of them going at once
+        indexed = list()
+        with ThreadPoolExecutor(max_workers=opts.parallel) as executor:
+            results = zip(inboxdirs, executor.map(lambda x: index_pi_inbox(x, opts, nofsync=nofsync), inboxdirs))
+            for inboxdir, success in results:
+                if success:
+                    indexed.append(inboxdir)
+                else:
+                    logger.critical('Unable to index %s', inboxdir)
+        return indexed
+
+    if len(inboxdirs) > 1 and index_pi_inboxes(inboxdirs, opts, nofsync=nofsync):
+        return inboxdirs
+
+    # Go one by one if there is just one, or to find out which ones failed
+    indexed = list()
+    for inboxdir in inboxdirs:
+        if index_pi_inbox(inboxdir, opts, nofsync=nofsync):
+            indexed.append(inboxdir)
+        else:
             logger.critical('Unable to index %s', inboxdir)
+    return indexed
+
+
+def get_pi_env(opts) -> dict:
+    env = {
+        'PI_CONFIG': opts.piconfig,
+        'PATH': os.getenv('PATH', '/bin:/usr/bin:/usr/local/bin'),
+    }
+    # Pass through the few things that change where and how public-inbox
+    # does its work, e.g. so indexing scratch files don't land on the wrong
+    # filesystem
+    for var in ('HOME', 'TMPDIR', 'LANG', 'LC_ALL', 'PERL5LIB'):
+        if var in os.environ:
+            env[var] = os.environ[var]
+    return env
+
+
+def get_realpath(path: str) -> str:
+    # Each inbox is looked up more than once, and the toplevels for all of
+    # them, but none of these paths change during the run
+    if path not in _realpaths:
+        _realpaths[path] = os.path.realpath(path)
+    return _realpaths[path]
 
 
 def get_git_pi_dir(opts, fullpath: str) -> Tuple[str, str]:
-    fullpath = os.path.realpath(fullpath)
+    fullpath = get_realpath(fullpath)
     if not opts.pitoplevel:
         # Public-inbox is in the same dir
         return fullpath, fullpath
     # Public-inbox is in a separate dir
-    pitop = os.path.realpath(opts.pitoplevel)
-    groktop = os.path.realpath(opts.toplevel)
+    pitop = get_realpath(opts.pitoplevel)
+    groktop = get_realpath(opts.toplevel)
     inboxname = os.path.relpath(fullpath, groktop)
     return fullpath, os.path.join(pitop, inboxname)
 
@@ -262,15 +397,16 @@ def cmd_init(opts):
             if os.path.exists(msgmapdbf):
                 logger.critical('Reinitializing %s', opts.inboxdir)
                 os.unlink(msgmapdbf)
-            if os.path.exists(os.path.join(pdir, 'xap15')):
-                shutil.rmtree(os.path.join(pdir, 'xap15'))
+            try:
+                os.unlink(os.path.join(pdir, 'grokmirror.indexstamp'))
+            except FileNotFoundError:
+                pass
+            xapdir = os.path.join(pdir, 'xap15')
+            if os.path.exists(xapdir):
+                shutil.rmtree(xapdir)
     elif not sys.stdin.isatty():
-        repos = list()
-        for line in sys.stdin.read().split('\n'):
-            if not line:
-                continue
-            repos.append(line)
-        inboxdirs = get_inboxdirs(repos)
+        # No need to hold on to the whole list of repos, we only want inboxes
+        inboxdirs = get_inboxdirs(line.rstrip('\n') for line in sys.stdin)
     else:
         logger.info('Nothing to do')
         sys.exit(0)
@@ -284,10 +420,7 @@ def cmd_update(opts):
 
 
 def cmd_extindex(opts):
-    env = {
-        'PI_CONFIG': opts.piconfig,
-        'PATH': os.getenv('PATH', '/bin:/usr/bin:/usr/local/bin'),
-    }
+    env = get_pi_env(opts)
     logger.info('Running extindex --all')
     piargs = ['public-inbox-extindex', '-L', opts.indexlevel, '--all']
     if opts.jobs:
@@ -327,11 +460,16 @@ def command():
                     help='Indexlevel to use with public-inbox (full, medium, basic)')
     ap.add_argument('-j', '--jobs', type=int,
                     help='The --jobs parameter to pass to public-inbox')
+    ap.add_argument('-P', '--parallel', type=int, default=1,
+                    help='Number of inboxes to index at the same time (each gets its own --jobs)')
     ap.add_argument('--no-fsync', dest='nofsync', action='store_true', default=False,
-                    help='Use --no-fsync when invoking public-inbox')
+                    help='Use --no-fsync when invoking public-inbox (an inbox being indexed during '
+                         'a system crash may need "init --force-reinit")')
 
     sp = ap.add_subparsers(help='sub-command help', dest='subcmd')
-    sp_init = sp.add_parser('init', help='Run public-inbox-init+index on repositories passed via stdin')
+    sp_init = sp.add_parser('init', help='Run public-inbox-init+index on repositories passed via stdin '
+                                         '(the first index of a new inbox always uses --no-fsync, so if '
+                                         'the system crashes during it, rerun with --force-reinit)')
 
     sp_init.add_argument('--local-toplevel', dest='local_toplevel', default='',
                          help='URL of the local mirror toplevel (omit if serving from /)')
@@ -345,14 +483,14 @@ def command():
                          default='indexheader,replyto',
                          help='Extra config options to accept from remote (comma-separated)')
     sp_init.add_argument('--force-reinit', dest='forceinit', action='store_true', default=False,
-                         help='Force a full (re-)init of an inboxdir')
+                         help='Force a full (re-)init of an inboxdir (e.g. after a crash during its first index)')
     sp_init.add_argument('inboxdir', nargs='?',
                          help='Path to toplevel inboxdir (non-hook mode)')
     sp_init.set_defaults(func=cmd_init)
 
-    sp_update = sp.add_parser('update', help='Run public-inbox-index on passed repository path')
-    sp_update.add_argument('repo', nargs=1,
-                           help='Full path to foo/git/N.git public-inbox repository')
+    sp_update = sp.add_parser('update', help='Run public-inbox-index on passed repository paths')
+    sp_update.add_argument('repo', nargs='+',
+                           help='Full path(s) to foo/git/N.git public-inbox repositories')
     sp_update.set_defaults(func=cmd_update)
 
     sp_extindex = sp.add_parser('extindex', help='Run extindex on all inboxes')
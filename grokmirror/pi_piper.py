@@ -13,6 +13,8 @@ import grokmirror
 import fnmatch
 import logging
 import shlex
+import subprocess
+import tempfile
 
 from typing import Optional
 
@@ -20,14 +22,41 @@ from typing import Optional
 logger = logging.getLogger(__name__)
 
 
-def git_get_message_from_pi(fullpath: str, commit_id: str) -> bytes:
-    logger.debug('Getting %s:m from %s', commit_id, fullpath)
-    args = ['show', f'{commit_id}:m']
-    ecode, out, err = grokmirror.run_git_command(fullpath, args, decode=False)
-    if ecode > 0:
-        logger.debug('Could not get the message, error below')
-        logger.debug(err.decode())
-        raise KeyError('Could not find %s in %s' % (commit_id, fullpath))
+def git_open_cat_file(fullpath: str) -> subprocess.Popen:
+    # One cat-file for all the messages we need, instead of a git show for each
+    cmdargs = grokmirror.get_git_cmdargs(fullpath, ['cat-file', '--batch'])
+    return subprocess.Popen(cmdargs, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, env=dict())
+
+
+def git_close_cat_file(catfile: subprocess.Popen) -> None:
+    catfile.stdin.close()
+    catfile.stdout.close()
+    catfile.wait()
+
+
+def git_get_message_from_pi(catfile: subprocess.Popen, commit_id: str) -> bytes:
+    logger.debug('Getting %s:m', commit_id)
+    try:
+        catfile.stdin.write(f'{commit_id}:m\n'.encode())
+        catfile.stdin.flush()
+    except BrokenPipeError:
+        raise KeyError('Could not find %s:m' % commit_id)
+    # <objectname> <objecttype> <objectsize>, or <object> missing
+    header = catfile.stdout.readline().split()
+    if len(header) != 3:
+        logger.debug('Could not get the message: %s', b' '.join(header).decode(errors='replace'))
+        raise KeyError('Could not find %s:m' % commit_id)
+    size = int(header[2])
+    if header[1] != b'blob':
+        # Read past the contents and the trailing newline, or the next
+        # request will parse them as its header
+        catfile.stdout.read(size + 1)
+        logger.debug('Not a message: %s', b' '.join(header).decode(errors='replace'))
+        raise KeyError('Could not find %s:m' % commit_id)
+    out = catfile.stdout.read(size)
+    # There's a newline after the contents
+    catfile.stdout.read(1)
     return out
 
 
@@ -40,7 +69,11 @@ def git_get_new_revs(fullpath: str, pipelast: Optional[int] = None) -> list:
             latest = fh.read().strip()
             rev_range = f'{latest}..'
 
-    args = ['rev-list', '--pretty=oneline', '--reverse', rev_range, 'master']
+    args = ['rev-list', '--reverse', rev_range, 'master']
+    # We only ever show subjects in debug output, so don't make git format
+    # them otherwise
+    if logger.isEnabledFor(logging.DEBUG):
+        args.insert(1, '--pretty=oneline')
     ecode, out, err = grokmirror.run_git_command(fullpath, args)
     if ecode > 0:
         raise KeyError('Could not iterate %s in %s' % (rev_range, fullpath))
@@ -48,13 +81,35 @@ def git_get_new_revs(fullpath: str, pipelast: Optional[int] = None) -> list:
     newrevs = list()
     if out:
         for line in out.split('\n'):
-            (commit_id, logmsg) = line.split(' ', 1)
+            # Commits with empty subjects have nothing after the commit id
+            commit_id, _, logmsg = line.partition(' ')
             logger.debug('commit_id=%s, subject=%s', commit_id, logmsg)
             newrevs.append((commit_id, logmsg))
 
     return newrevs
 
 
+def write_latest(statf: str, commit_id: str) -> None:
+    # Write to a tempfile and move it into place, so a crash can't leave us
+    # with a truncated file and no idea where we stopped
+    (dirname, basename) = os.path.split(statf)
+    (fd, tmpfile) = tempfile.mkstemp(prefix=basename, dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(commit_id)
+            fh.flush()
+            grokmirror.fdatasync(fd)
+        # set mode to current umask
+        curmask = os.umask(0)
+        os.chmod(tmpfile, 0o0666 ^ curmask)
+        os.umask(curmask)
+        os.replace(tmpfile, statf)
+    finally:
+        # If something failed, don't leave these trailing around
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+
 def reshallow(repo: str, commit_id: str) -> int:
     with open(os.path.join(repo, 'shallow'), 'w') as fh:
         fh.write(commit_id)
@@ -74,8 +129,7 @@ def init_piper_tracking(repo: str, shallow: bool) -> bool:
     # Just write latest into the tracking file and return
     latest = out.strip()
     statf = os.path.join(repo, 'pi-piper.latest')
-    with open(statf, 'w') as fh:
-        fh.write(latest)
+    write_latest(statf, latest)
     if shallow:
         reshallow(repo, latest)
     return True
@@ -127,28 +181,31 @@ def run_pi_repo(repo: str, pipedef: str, dryrun: bool = False, shallow: bool = F
 
     latest_good = None
     ecode = 0
-    for commit_id, subject in revlist:
-        try:
-            msgbytes = git_get_message_from_pi(repo, commit_id)
-            if dryrun:
-                logger.info('  piping: %s (%s b) [DRYRUN]', commit_id, len(msgbytes))
-                logger.debug(' subject: %s', subject)
-            else:
-                logger.info('  piping: %s (%s b)', commit_id, len(msgbytes))
-                logger.debug(' subject: %s', subject)
-                ecode, out, err = grokmirror.run_shell_command(args, stdin=msgbytes)
-                if ecode > 0:
-                    logger.info('Error running %s', pipedef)
-                    logger.info(err)
-                    break
-                latest_good = commit_id
-        except KeyError:
-            logger.info('Skipping %s', commit_id)
+    catfile = git_open_cat_file(repo)
+    try:
+        for commit_id, subject in revlist:
+            try:
+                msgbytes = git_get_message_from_pi(catfile, commit_id)
+                if dryrun:
+                    logger.info('  piping: %s (%s b) [DRYRUN]', commit_id, len(msgbytes))
+                    logger.debug(' subject: %s', subject)
+                else:
+                    logger.info('  piping: %s (%s b)', commit_id, len(msgbytes))
+                    logger.debug(' subject: %s', subject)
+                    ecode, out, err = grokmirror.run_shell_command(args, stdin=msgbytes)
+                    if ecode > 0:
+                        logger.info('Error running %s', pipedef)
+                        logger.info(err)
+                        break
+                    latest_good = commit_id
+            except KeyError:
+                logger.info('Skipping %s', commit_id)
+    finally:
+        git_close_cat_file(catfile)
 
     if latest_good and not dryrun:
-        with open(statf, 'w') as fh:
-            fh.write(latest_good)
-            logger.info('Wrote %s', statf)
+        write_latest(statf, latest_good)
+        logger.info('Wrote %s', statf)
         if ecode == 0 and shallow:
             reshallow(repo, latest_good)
 
@@ -186,7 +243,7 @@ def command():
         sys.stderr.write('ERORR: File does not exist: %s\n' % cfgfile)
         sys.exit(1)
     config = ConfigParser(interpolation=ExtendedInterpolation())
-    config.read(os.path.expanduser(cfgfile))
+    config.read(os.path.expanduser(cfgfile), encoding='utf-8')
 
     # Find out the section that we want from the config file
     section = 'DEFAULT'
@@ -25,6 +25,7 @@ import time
 import gzip
 import json
 import fnmatch
+import re
 import shutil
 import tempfile
 import signal
@@ -37,10 +38,13 @@ import multiprocessing as mp
 import queue
 
 from socketserver import UnixStreamServer, StreamRequestHandler, ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor
 
 # default basic logger. We override it later.
 logger = logging.getLogger(__name__)
 
+_glob_res = dict()
+
 
 class SignalHandler:
 
@@ -293,6 +297,7 @@ def pull_worker(config, q_pull, q_spa, q_done):
     remotename = config['pull'].get('remotename', '_grokmirror')
     # Should we use plumbing for objstore operations?
     objstore_uses_plumbing = config['core'].getboolean('objstore_uses_plumbing', False)
+    clone_filter = config['pull'].get('clone_filter')
 
     while True:
         try:
@@ -356,6 +361,8 @@ def pull_worker(config, q_pull, q_spa, q_done):
                 set_repo_params(fullpath, repoinfo)
                 if altrepo:
                     grokmirror.set_altrepo(fullpath, altrepo)
+                elif clone_filter and not repoinfo.get('forkgroup'):
+                    set_partial_clone(fullpath, remotename, clone_filter)
                 action = 'pull'
             except (PermissionError, IOError) as ex:
                 logger.critical('Unable to remove %s: %s', fullpath, str(ex))
@@ -445,7 +452,7 @@ def pull_worker(config, q_pull, q_spa, q_done):
                         logger.debug('Removed existing wrong symlink %s', target)
                         os.unlink(target)
                 elif os.path.exists(target):
-                    logger.warning('Deleted repo %s, because it is now a symlink to %s' % (target, fullpath))
+                    logger.warning('Deleted repo %s, because it is now a symlink to %s', target, fullpath)
                     shutil.rmtree(target)
 
                 # Here we re-check if we still need to do anything
@@ -461,9 +468,18 @@ def pull_worker(config, q_pull, q_spa, q_done):
             q_spa.put((gitdir, spa_actions))
 
 
+def get_glob_re(cfgval):
+    # One regex for all the globs in a config value, so each repo only
+    # needs a single match against it
+    if cfgval not in _glob_res:
+        globs = cfgval.split('\n')
+        _glob_res[cfgval] = re.compile('|'.join(fnmatch.translate(x) for x in globs))
+    return _glob_res[cfgval]
+
+
 def cull_manifest(manifest, config):
-    includes = config['pull'].get('include', '*').split('\n')
-    excludes = config['pull'].get('exclude', '').split('\n')
+    include_re = get_glob_re(config['pull'].get('include', '*'))
+    exclude_re = get_glob_re(config['pull'].get('exclude', ''))
 
     culled = dict()
 
@@ -471,19 +487,9 @@ def cull_manifest(manifest, config):
         if not repoinfo.get('fingerprint'):
             logger.critical('Repo without fingerprint info (skipped): %s', gitdir)
             continue
-        # does it fall under include?
-        for include in includes:
-            if fnmatch.fnmatch(gitdir, include):
-                # Yes, but does it fall under excludes?
-                excluded = False
-                for exclude in excludes:
-                    if fnmatch.fnmatch(gitdir, exclude):
-                        excluded = True
-                        break
-                if excluded:
-                    continue
-
-                culled[gitdir] = manifest[gitdir]
+        # does it fall under include, but not under excludes?
+        if include_re.match(gitdir) and not exclude_re.match(gitdir):
+            culled[gitdir] = manifest[gitdir]
 
     return culled
 
@@ -491,8 +497,12 @@ def cull_manifest(manifest, config):
 def fix_remotes(toplevel, gitdir, site, config):
     remotename = config['pull'].get('remotename', '_grokmirror')
     fullpath = os.path.join(toplevel, gitdir.lstrip('/'))
+    clone_filter = None
     # Set our remote
     if remotename in grokmirror.list_repo_remotes(fullpath):
+        # Removing the remote drops its partial clone settings, so remember them
+        rcfg = grokmirror.get_config_from_git(fullpath, r'remote\.%s\.partialclonefilter' % re.escape(remotename))
+        clone_filter = rcfg.get('partialclonefilter')
         logger.debug('\tremoving remote: %s', remotename)
         ecode, out, err = grokmirror.run_git_command(fullpath, ['remote', 'remove', remotename])
         if ecode > 0:
@@ -516,9 +526,26 @@ def fix_remotes(toplevel, gitdir, site, config):
         logger.debug('\tset %s as %s (ff-only)', remotename, url)
     else:
         logger.debug('\tset %s as %s', remotename, url)
+
+    if clone_filter:
+        # Already a partial clone, so it has to stay one
+        set_partial_clone(fullpath, remotename, clone_filter)
     return True
 
 
+def set_partial_clone(fullpath, remotename, clone_filter):
+    # Make it a partial clone, so fetches only get the objects allowed by the filter
+    grokmirror.set_git_config(fullpath, 'core.repositoryformatversion', '1')
+    grokmirror.set_git_config(fullpath, 'extensions.partialClone', remotename)
+    grokmirror.set_git_config(fullpath, 'remote.{}.promisor'.format(remotename), 'true')
+    grokmirror.set_git_config(fullpath, 'remote.{}.partialclonefilter'.format(remotename), clone_filter)
+    logger.debug('\tset %s filter to %s', remotename, clone_filter)
+    # Objstore repos fetch all objects from the repos using them, which
+    # can't work with a repo that is missing some of them
+    with open(os.path.join(fullpath, 'grokmirror.do-not-objstore'), 'w') as fh:
+        fh.write('Partial clone with filter %s\n' % clone_filter)
+
+
 def set_repo_params(fullpath, repoinfo):
     owner = repoinfo.get('owner')
     description = repoinfo.get('description')
@@ -694,7 +721,7 @@ def write_projects_list(config, manifest):
                     symlink = symlink.lstrip('/')
                     fh.write('{}\n'.format(symlink).encode())
 
-        os.fsync(fd)
+        grokmirror.fdatasync(fd)
         fh.close()
         # set mode to current umask
         curmask = os.umask(0)
@@ -710,6 +737,16 @@ def write_projects_list(config, manifest):
     logger.info(' projlist: wrote %s', plpath)
 
 
+def get_pull_threads(config):
+    pull_threads = config['pull'].getint('pull_threads', 0)
+    if pull_threads < 1 and mp.cpu_count() > 1:
+        # take half of available CPUs by default
+        pull_threads = int(mp.cpu_count() / 2)
+    elif pull_threads < 1:
+        pull_threads = 1
+    return pull_threads
+
+
 def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
     # l_ = local, r_ = remote
     l_mani_path = config['core'].get('manifest')
@@ -870,6 +907,21 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
                 r_culled[s_gitdir]['forkgroup'] = forkgroup
                 r_culled[s_gitdir]['private'] = is_private
 
+    # If our manifest already has the same fingerprint as the remote, trust it,
+    # since we always write grokmirror.fingerprint before updating the manifest.
+    # For the rest we need to look at the repo, which may need to run git show-ref
+    # if it doesn't have a cached fingerprint yet, so do it in parallel
+    l_gitdirs = list()
+    for gitdir, repoinfo in r_culled.items():
+        if gitdir not in l_manifest:
+            continue
+        l_fingerprint = l_manifest[gitdir].get('fingerprint')
+        if l_fingerprint is None or l_fingerprint != repoinfo.get('fingerprint'):
+            l_gitdirs.append(gitdir)
+    with ThreadPoolExecutor(max_workers=get_pull_threads(config)) as executor:
+        l_fingerprints = dict(zip(l_gitdirs, executor.map(lambda x: grokmirror.get_repo_fingerprint(toplevel, x),
+                                                          l_gitdirs)))
+
     seen = set()
     to_migrate = set()
     # Used to track symlinks so we can properly avoid purging them
@@ -926,7 +978,10 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
                         q_mani.put((gitdir, repoinfo, 'fix_params'))
                         break
 
-            my_fingerprint = grokmirror.get_repo_fingerprint(toplevel, gitdir)
+            if gitdir in l_fingerprints:
+                my_fingerprint = l_fingerprints[gitdir]
+            else:
+                my_fingerprint = l_manifest[gitdir].get('fingerprint')
             if my_fingerprint != l_manifest[gitdir].get('fingerprint'):
                 logger.debug('Fingerprint discrepancy, forcing a fetch')
                 q_mani.put((gitdir, repoinfo, 'pull'))
@@ -971,6 +1026,10 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
                 # Can't use this sibling for anything, as it's private
                 continue
 
+            if os.path.exists(os.path.join(s_fullpath, 'grokmirror.do-not-objstore')):
+                # E.g. a partial clone, which we can't fetch all objects from
+                continue
+
             if os.path.isdir(s_fullpath):
                 found_existing = True
                 if s_gitdir not in to_migrate:
@@ -1084,9 +1143,11 @@ def update_manifest(config, entries):
     if changed:
         if 'manifest' in config:
             pretty = config['manifest'].getboolean('pretty', False)
+            compresslevel = config['manifest'].getint('compresslevel', 6)
         else:
             pretty = False
-        grokmirror.write_manifest(manifile, manifest, pretty=pretty)
+            compresslevel = 6
+        grokmirror.write_manifest(manifile, manifest, pretty=pretty, compresslevel=compresslevel)
         logger.info(' manifest: wrote %s (%d entries)', manifile, len(manifest))
         # write out projects.list, if asked to
         write_projects_list(config, manifest)
@@ -1171,12 +1232,7 @@ def pull_mirror(config, nomtime=False, forcepurge=False, runonce=False):
         nomtime = True
     lastrun = 0
 
-    pull_threads = config['pull'].getint('pull_threads', 0)
-    if pull_threads < 1 and mp.cpu_count() > 1:
-        # take half of available CPUs by default
-        pull_threads = int(mp.cpu_count() / 2)
-    elif pull_threads < 1:
-        pull_threads = 1
+    pull_threads = get_pull_threads(config)
 
     busy = set()
     done = list()
@@ -1186,6 +1242,8 @@ def pull_mirror(config, nomtime=False, forcepurge=False, runonce=False):
     loopmark = None
     post_clone_hook = config['pull'].get('post_clone_complete_hook')
     post_work_hook = config['pull'].get('post_work_complete_hook')
+    # Only applied to new repos that don't share objects with any others
+    clone_filter = config['pull'].get('clone_filter')
     with SignalHandler(config, sw, dws, pws, done):
         while True:
             for pw in pws:
@@ -1365,9 +1423,13 @@ def pull_mirror(config, nomtime=False, forcepurge=False, runonce=False):
 
             fix_remotes(toplevel, gitdir, config['remote'].get('site'), config)
             set_repo_params(fullpath, repoinfo)
+            forkgroup = repoinfo.get('forkgroup')
+            if clone_filter and not forkgroup:
+                set_partial_clone(fullpath, config['pull'].get('remotename', '_grokmirror'), clone_filter)
+            elif clone_filter:
+                logger.info('   filter: not using %s for %s (uses objstore)', clone_filter, gitdir)
             grokmirror.unlock_repo(fullpath)
 
-            forkgroup = repoinfo.get('forkgroup')
             if not forkgroup:
                 logger.debug('no-sibling clone: %s', gitdir)
                 q_pull.put((gitdir, repoinfo, 'pull', q_action))